@@ -0,0 +1,35 @@
+#!/usr/bin/python
+
+# Adds a user who can log in, or sets a new password for an existing one.
+# Works whether or not the router is running.
+#
+#   python add_user.py config.db <name>
+
+import sys
+import sqlite3
+import getpass
+
+from atom.router.directory import CREATE_USERS_TABLE
+from atom.router.passwords import hash_password
+
+def main():
+    if len(sys.argv) != 3:
+        print 'usage: {} <db_filename> <name>'.format(sys.argv[0])
+        sys.exit(1)
+    db_filename, name = sys.argv[1:]
+    
+    password = getpass.getpass('Password for {}: '.format(name))
+    if not password or password != getpass.getpass('Again: '):
+        print 'Passwords are empty or do not match'
+        sys.exit(1)
+    stored = hash_password(password)
+    
+    conn = sqlite3.connect(db_filename)
+    conn.execute(CREATE_USERS_TABLE)
+    if conn.execute('UPDATE users SET password = ? WHERE name = ?', (stored, name)).rowcount == 0:
+        conn.execute('INSERT INTO users VALUES (NULL, ?, ?)', (name, stored))
+    conn.commit()
+    conn.close()
+
+if __name__ == '__main__':
+    main()
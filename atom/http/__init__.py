@@ -1,4 +1,6 @@
-from atom.http.exceptions import HTTPError, HTTPConnectionClosedError, HTTPSyntaxError, HTTPTimeoutError
+from atom.http.exceptions import HTTPError, HTTPConnectionClosedError, HTTPSyntaxError, HTTPTimeoutError, HTTPBodyTooLargeError
+from atom.http.deadline import Timeouts
+from atom.http.forms import FormLimits, FormFile, parse_form, close_files
 from atom.http.headers import HTTPHeaders
 from atom.http.socket import HTTPSocket
-from atom.http.socketpair import LoggingSocket, FakeSocketPair, http_socket_pair
\ No newline at end of file
+from atom.http.socketpair import LoggingSocket, MemorySocket, memory_socket_pair, http_socket_pair
\ No newline at end of file
@@ -0,0 +1,79 @@
+RECV_BUFFER_SIZE = 16384
+
+
+class ReceiveBuffer(object):
+    # Data lives in one bytearray between _start and _end and is filled in
+    # place with recv_into. Consuming data only moves _start forward, and the
+    # buffer rewinds for free whenever it drains. Pieces returned by take()
+    # are memoryviews into the buffer, so they are only valid until the next
+    # call to fill().
+    
+    def __init__(self, sock, size = RECV_BUFFER_SIZE):
+        self._sock = sock
+        self._data = bytearray(size)
+        self._view = memoryview(self._data)
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+    
+    def __len__(self):
+        return self._end - self._start
+    
+    def fill(self):
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        elif self._end == len(self._data):
+            self._make_room()
+        
+        size = self._sock.recv_into(self._view[self._end:])
+        self._end += size
+        return size
+    
+    def _make_room(self):
+        used = self._end - self._start
+        if used > len(self._data) // 2:
+            # Allocate a new array rather than resizing in place, so views
+            # that were already handed out stay valid
+            data = bytearray(len(self._data) * 2)
+            data[:used] = self._view[self._start:self._end]
+            self._data = data
+            self._view = memoryview(data)
+        else:
+            self._view[:used] = self._view[self._start:self._end]
+        self._scan -= self._start
+        self._start, self._end = 0, used
+    
+    def find(self, sep):
+        # Returns the offset of sep relative to the buffered data, or -1. A
+        # failed search remembers where it stopped so the next one resumes
+        # there instead of rescanning the whole line.
+        pos = self._data.find(sep, max(self._start, self._scan), self._end)
+        if pos == -1:
+            self._scan = max(self._start, self._end - len(sep) + 1)
+            return -1
+        return pos - self._start
+    
+    def rfind(self, sep):
+        pos = self._data.rfind(sep, self._start, self._end)
+        return pos - self._start if pos != -1 else -1
+    
+    def count(self, sep, offset = 0):
+        return self._data.count(sep, self._start + offset, self._end)
+    
+    def startswith(self, prefix):
+        return self._data.startswith(prefix, self._start, self._end)
+    
+    def read(self, size):
+        data = self._view[self._start:self._start + size].tobytes()
+        self.skip(size)
+        return data
+    
+    def take(self, size):
+        size = min(size, self._end - self._start)
+        piece = self._view[self._start:self._start + size]
+        self.skip(size)
+        return piece
+    
+    def skip(self, size):
+        self._start += size
+        self._scan = self._start
@@ -0,0 +1,115 @@
+import time
+
+from gevent import spawn, sleep, getcurrent
+from gevent.hub import get_hub
+
+TIMER_RESOLUTION = 0.5
+
+
+class Timeouts(object):
+    # Time budgets in seconds for one side of a connection; None means no
+    # limit. header covers a whole header block, body_idle any wait for more
+    # of a body, request everything from the start of a request to the end
+    # of its body and keepalive the wait for the next request.
+    def __init__(self, header = None, body_idle = None, request = None, keepalive = None):
+        self.header = header
+        self.body_idle = body_idle
+        self.request = request
+        self.keepalive = keepalive
+
+
+class TimerWheel(object):
+    # Deadlines are kept in a bucket per tick, and a single greenlet checks
+    # each bucket as its tick passes. Moving a deadline later only updates
+    # it; it goes into its new bucket when the old one comes round. Cancelled
+    # deadlines are taken out, so nothing holds on to them or their greenlets.
+    # Each pass starts from the lowest tick armed since the last one, so
+    # buckets whose tick passed while the hub was busy are still checked.
+    
+    def __init__(self, resolution = TIMER_RESOLUTION):
+        self.resolution = resolution
+        self._buckets = {}
+        self._runner = None
+        self._low = None
+    
+    def schedule(self, deadline):
+        self.unschedule(deadline)
+        tick = int(max(deadline.expires, time.time()) / self.resolution) + 1
+        self._buckets.setdefault(tick, set()).add(deadline)
+        deadline._tick = tick
+        if self._low == None or tick < self._low:
+            self._low = tick
+        if not self._runner:
+            self._runner = spawn(self._run)
+    
+    def unschedule(self, deadline):
+        bucket = self._buckets.get(deadline._tick)
+        if bucket:
+            bucket.discard(deadline)
+            if not bucket:
+                del self._buckets[deadline._tick]
+        deadline._tick = None
+    
+    def _run(self):
+        try:
+            while self._buckets:
+                sleep(max(0, (int(time.time() / self.resolution) + 1) * self.resolution - time.time()))
+                now = time.time()
+                current = int(now / self.resolution)
+                tick, self._low = self._low, None
+                while tick <= current:
+                    for deadline in self._buckets.pop(tick, ()):
+                        deadline._check(tick, now)
+                    tick += 1
+                if self._low == None or tick < self._low:
+                    self._low = tick
+        finally:
+            self._runner = None
+            self._low = None
+
+_wheel = TimerWheel()
+
+
+class Deadline(object):
+    # A point in time by which the greenlet that armed it must have called
+    # cancel, or the given exception is raised in it. Arming and cancelling
+    # are a few set operations, cheap enough to do around every read.
+    
+    def __init__(self, wheel = None):
+        self._wheel = wheel or _wheel
+        self.expires = None
+        self._tick = None
+        self._greenlet = None
+        self._exception = None
+        self._generation = 0
+    
+    def arm(self, expires, exception):
+        self.expires = expires
+        self._greenlet = getcurrent()
+        self._exception = exception
+        self._generation += 1
+        if self._tick == None or expires < (self._tick - 1) * self._wheel.resolution:
+            self._wheel.schedule(self)
+    
+    def cancel(self):
+        self.expires = None
+        self._greenlet = None
+        self._exception = None
+        self._generation += 1
+        if self._tick != None:
+            self._wheel.unschedule(self)
+    
+    def _check(self, tick, now):
+        self._tick = None
+        if self.expires == None:
+            return
+        if self.expires > now:
+            self._wheel.schedule(self)
+            return
+        get_hub().loop.run_callback(self._fire, self._generation)
+    
+    def _fire(self, generation):
+        if generation == self._generation and not self._greenlet.dead:
+            greenlet, exception = self._greenlet, self._exception
+            self.cancel()
+            greenlet.throw(exception)
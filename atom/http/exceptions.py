@@ -9,4 +9,7 @@ class HTTPConnectionClosedError(HTTPError):
     pass
 
 class HTTPSyntaxError(HTTPError):
+    pass
+
+class HTTPBodyTooLargeError(HTTPError):
     pass
\ No newline at end of file
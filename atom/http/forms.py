@@ -0,0 +1,238 @@
+import re
+
+from urlparse import parse_qsl
+from tempfile import SpooledTemporaryFile, TemporaryFile
+
+from atom.http.exceptions import HTTPSyntaxError, HTTPBodyTooLargeError
+
+MAX_FORM_SIZE = 16*1024*1024
+MAX_FORM_MEMORY = 1024*1024
+MAX_FIELD_SIZE = 64*1024
+MAX_FORM_FIELDS = 1000
+FORM_SPOOL_SIZE = 64*1024
+MAX_PART_HEADER_SIZE = 8192
+MAX_BOUNDARY_LENGTH = 70
+
+PARAM_RE = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+_PREAMBLE, _DELIMITER, _HEADERS, _BODY, _EPILOGUE = range(5)
+
+
+class FormLimits(object):
+    # Bounds on parsing a form body; None means no limit. max_size covers
+    # the whole body including uploaded files, max_memory the names and
+    # values kept in memory, max_field_size any one value and max_fields the
+    # number of fields and files. Files larger than spool_size go to a
+    # temporary file, all of them if it is 0.
+    def __init__(self, max_size = MAX_FORM_SIZE, max_memory = MAX_FORM_MEMORY,
+                 max_field_size = MAX_FIELD_SIZE, max_fields = MAX_FORM_FIELDS,
+                 spool_size = FORM_SPOOL_SIZE):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.max_field_size = max_field_size
+        self.max_fields = max_fields
+        self.spool_size = spool_size
+
+DEFAULT_FORM_LIMITS = FormLimits()
+
+
+class FormFile(object):
+    # An uploaded file; once the form is parsed, file is positioned at the
+    # start of its contents
+    def __init__(self, name, filename, content_type, spool_size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.file = SpooledTemporaryFile(spool_size) if spool_size else TemporaryFile()
+    
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+    
+    def close(self):
+        self.file.close()
+
+
+def parse_form(content_type, pieces, limits = DEFAULT_FORM_LIMITS):
+    # Parses a form body as its pieces arrive, into a dict of lists of
+    # values like parse_qs gives. Uploaded files appear as FormFiles.
+    kind, params = parse_content_type(content_type or '')
+    if kind == 'application/x-www-form-urlencoded':
+        return _parse_urlencoded(pieces, limits)
+    elif kind == 'multipart/form-data':
+        boundary = params.get('boundary')
+        if not boundary or len(boundary) > MAX_BOUNDARY_LENGTH:
+            raise HTTPSyntaxError('Invalid multipart boundary')
+        return _parse_multipart(pieces, boundary, limits)
+    else:
+        raise HTTPSyntaxError('Unsupported form content type "{}"'.format(kind))
+
+def parse_content_type(value):
+    # 'type/subtype; name="value"' -> ('type/subtype', {'name': 'value'})
+    kind, _, rest = value.partition(';')
+    params = {}
+    for name, param in PARAM_RE.findall(';' + rest):
+        if param.startswith('"'):
+            param = re.sub(r'\\(.)', r'\1', param[1:-1])
+        params[name.lower()] = param.strip()
+    return kind.strip().lower(), params
+
+
+class _Form(object):
+    def __init__(self, limits):
+        self.limits = limits
+        self.fields = {}
+        self.size = 0
+        self.memory = 0
+        self.count = 0
+    
+    def received(self, data):
+        self.size += len(data)
+        if _over(self.size, self.limits.max_size):
+            raise HTTPBodyTooLargeError('Form body too large')
+    
+    def add(self, name, value):
+        self.count += 1
+        self.memory += len(name)
+        if not isinstance(value, FormFile):
+            self.memory += len(value)
+            if _over(len(value), self.limits.max_field_size):
+                raise HTTPBodyTooLargeError('Form field too large')
+        if _over(self.count, self.limits.max_fields):
+            raise HTTPBodyTooLargeError('Too many form fields')
+        if _over(self.memory, self.limits.max_memory):
+            raise HTTPBodyTooLargeError('Form fields too large')
+        self.fields.setdefault(name, []).append(value)
+    
+    def add_pairs(self, data):
+        for name, value in parse_qsl(data):
+            self.add(name, value)
+
+def _parse_urlencoded(pieces, limits):
+    # Complete pairs are parsed as they arrive, so only the pair still
+    # arriving is held back
+    form = _Form(limits)
+    pending = bytearray()
+    for piece in pieces:
+        form.received(piece)
+        pending += piece
+        end = pending.rfind('&')
+        if end >= 0:
+            form.add_pairs(str(pending[:end]))
+            del pending[:end+1]
+        if _over(len(pending), limits.max_field_size):
+            raise HTTPBodyTooLargeError('Form field too large')
+    form.add_pairs(str(pending))
+    return form.fields
+
+def _parse_multipart(pieces, boundary, limits):
+    # Files received so far are closed if the body turns out to be bad
+    form = _Form(limits)
+    try:
+        _read_parts(form, pieces, boundary, limits)
+    except:
+        close_files(form.fields)
+        raise
+    return form.fields
+
+def close_files(fields):
+    for values in fields.itervalues():
+        for value in values:
+            if isinstance(value, FormFile):
+                value.close()
+
+def _read_parts(form, pieces, boundary, limits):
+    # Only as much of the body is buffered as could be the start of a
+    # delimiter; everything before that goes to the current part. The line
+    # break before a delimiter belongs to it, including before the first.
+    delimiter = '\r\n--' + boundary
+    buf = bytearray('\r\n')
+    state = _PREAMBLE
+    part = None
+    
+    for piece in pieces:
+        form.received(piece)
+        buf += piece
+        while True:
+            if state == _PREAMBLE or state == _BODY:
+                i = buf.find(delimiter)
+                end = i if i >= 0 else max(0, len(buf) - len(delimiter) + 1)
+                if state == _BODY and end > 0:
+                    _part_data(part, buf[:end], limits)
+                if i < 0:
+                    del buf[:end]
+                    break
+                if state == _BODY:
+                    _end_part(form, part)
+                del buf[:i+len(delimiter)]
+                state = _DELIMITER
+            
+            elif state == _DELIMITER:
+                if len(buf) < 2:
+                    break
+                if buf[:2] == '--':
+                    state = _EPILOGUE
+                    continue
+                i = buf.find('\r\n')
+                if i < 0:
+                    if len(buf) > MAX_PART_HEADER_SIZE:
+                        raise HTTPSyntaxError('Invalid multipart delimiter')
+                    break
+                if buf[:i].strip(' \t'):
+                    raise HTTPSyntaxError('Invalid multipart delimiter')
+                del buf[:i+2]
+                state = _HEADERS
+            
+            elif state == _HEADERS:
+                if buf[:2] == '\r\n':
+                    raise HTTPSyntaxError('Multipart part without headers')
+                i = buf.find('\r\n\r\n')
+                if i < 0:
+                    if len(buf) > MAX_PART_HEADER_SIZE:
+                        raise HTTPSyntaxError('Multipart part headers too long')
+                    break
+                part = _start_part(form, str(buf[:i]), limits)
+                del buf[:i+4]
+                state = _BODY
+            
+            else:
+                del buf[:]
+                break
+    
+    if state != _EPILOGUE:
+        raise HTTPSyntaxError('Incomplete multipart body')
+
+def _start_part(form, header_block, limits):
+    headers = {}
+    for line in header_block.split('\r\n'):
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HTTPSyntaxError('Invalid multipart header')
+        headers[name.strip().lower()] = value.strip()
+    
+    disposition, params = parse_content_type(headers.get('content-disposition', ''))
+    if disposition != 'form-data' or 'name' not in params:
+        raise HTTPSyntaxError('Invalid multipart Content-Disposition')
+    if 'filename' in params:
+        part = FormFile(params['name'], params['filename'], headers.get('content-type'), limits.spool_size)
+        form.add(part.name, part)
+        return part
+    return (params['name'], bytearray())
+
+def _part_data(part, data, limits):
+    if isinstance(part, FormFile):
+        part.write(str(data))
+    else:
+        part[1].extend(data)
+        if _over(len(part[1]), limits.max_field_size):
+            raise HTTPBodyTooLargeError('Form field too large')
+
+def _end_part(form, part):
+    if isinstance(part, FormFile):
+        part.file.seek(0)
+    else:
+        form.add(part[0], str(part[1]))
+
+def _over(value, limit):
+    return limit != None and value > limit
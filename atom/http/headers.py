@@ -8,6 +8,7 @@ log = get_logger(__name__)
 
 status_codes = {
     100: 'Continue',
+    101: 'Switching Protocols',
     200: 'OK',
     302: 'Found',
     400: 'Bad Request',
@@ -15,20 +16,38 @@ status_codes = {
     404: 'Not Found',
     405: 'Method Not Allowed',
     411: 'Length Required',
+    413: 'Request Entity Too Large',
+    429: 'Too Many Requests',
     500: 'Internal Server Error',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
 }
 
 days = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun']
 months = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
 
 
+_unknown = object()
+
+
 class HTTPHeaders(object):
+    # Headers are kept in arrival order in _headers as [lower, name, value]
+    # entries, and _index maps each lowercase name to its entries. Removing a
+    # header blanks its entries in place (lower becomes None) and the list is
+    # compacted once enough of them have piled up.
+    
     def __init__(self, type_):
         assert type_ in ('request', 'response')
         self.type = type_
         self._headers = []
-        self._chunked = None
-        self._content_length = None
+        self._index = {}
+        self._num_removed = 0
+        self._raw_headers = None
+        self._chunked = _unknown
+        self._content_length = _unknown
+        self._url = None
+        self._args = None
+        self._cookies = None
     
     @classmethod
     def parse(cls, type_, lines):
@@ -51,28 +70,28 @@ class HTTPHeaders(object):
         if self.http_version != 'HTTP/1.1':
             raise HTTPSyntaxError('Unknown HTTP version: "{}"'.format(self.http_version))
         
-        cur_header = None
+        # Build the header entries directly rather than going through add(),
+        # keeping values exactly as received
+        headers, index = self._headers, self._index
         for line in lines[1:]:
             if line[0] in ' \t':
-                if cur_header == None:
+                if len(headers) == 0:
                     raise HTTPSyntaxError('Invalid header: "{}"'.format(line))
-                cur_header += '\r\n' + line
+                headers[-1][2] += '\r\n' + line
             else:
-                if cur_header != None:
-                    self._add_raw(cur_header)
-                cur_header = line
-        if cur_header != None:
-            self._add_raw(cur_header)
+                name, sep, value = line.partition(':')
+                if not sep:
+                    raise HTTPSyntaxError('Invalid header: "{}"'.format(line))
+                entry = [name.lower().strip(), name, value]
+                headers.append(entry)
+                if entry[0] in index:
+                    index[entry[0]].append(entry)
+                else:
+                    index[entry[0]] = [entry]
         
         self.check_syntax()
         return self
     
-    def _add_raw(self, header):
-        parts = header.split(':',1)
-        if len(parts) != 2:
-            raise HTTPSyntaxError('Invalid header: "{}"'.format(header))
-        self.add(parts[0], parts[1])
-    
     @classmethod
     def response(cls, code, message = None):
         self = cls('response')
@@ -92,26 +111,51 @@ class HTTPHeaders(object):
     @property
     def raw(self):
         if self.type == 'request':
-            ret = ['{} {} {}'.format(self.method, self.uri, self.http_version)]
+            first_line = '{} {} {}\r\n'.format(self.method, self.uri, self.http_version)
         else:
-            ret = ['{} {} {}'.format(self.http_version, self.code, self.message)]
-        ret.extend('{}:{}'.format(h[1], h[2]) for h in self._headers)
-        return '\r\n'.join(ret) + '\r\n\r\n'
+            first_line = '{} {} {}\r\n'.format(self.http_version, self.code, self.message)
+        if self._raw_headers == None:
+            self._raw_headers = ''.join([h[1] + ':' + h[2] + '\r\n' for h in self._headers if h[0] != None])
+        return first_line + self._raw_headers + '\r\n'
     
     def add(self, name, value):
-        self._headers.append([name.lower().strip(), name, ' ' + value])
-        self._updated()
+        entry = [name.lower().strip(), name, ' ' + value]
+        self._headers.append(entry)
+        self._index.setdefault(entry[0], []).append(entry)
+        self._updated(entry[0])
     
     def remove(self, name):
-        self._headers = [h for h in self._headers if h[0] != name.lower()]
-        self._updated()
+        lower = name.lower()
+        if lower in self._index:
+            self._remove_entries(lower, self._index[lower])
+    
+    def _remove_entries(self, lower, entries):
+        if not entries:
+            return
+        removed = set(id(h) for h in entries)
+        remaining = [h for h in self._index[lower] if id(h) not in removed]
+        if remaining:
+            self._index[lower] = remaining
+        else:
+            del self._index[lower]
+        
+        for h in entries:
+            h[0] = None
+        self._num_removed += len(entries)
+        if self._num_removed > len(self._headers) // 2:
+            self._headers = [h for h in self._headers if h[0] != None]
+            self._num_removed = 0
+        self._updated(lower)
     
     def set(self, name, value):
         self.remove(name)
         self.add(name, value)
     
     def get(self, name):
-        return [h[2].strip() for h in self._headers if h[0] == name.lower()]
+        return [h[2].strip() for h in self._index.get(name.lower(), ())]
+    
+    def has_token(self, name, token):
+        return any(t.strip().lower() == token for v in self.get(name) for t in v.split(','))
     
     def get_single(self, name):
         vals = self.get(name)
@@ -124,13 +168,17 @@ class HTTPHeaders(object):
         self.get_content_length()
         return True
     
-    def _updated(self):
-        self._chunked = None
-        self._content_length = None
+    def _updated(self, lower):
+        self._raw_headers = None
+        if lower in ('transfer-encoding', 'content-length'):
+            self._chunked = _unknown
+            self._content_length = _unknown
+        elif lower == 'cookie':
+            self._cookies = None
     
     def get_chunked(self):
-        if self._chunked == None:
-            te_headers = [h[2] for h in self._headers if h[0] == 'transfer-encoding']
+        if self._chunked is _unknown:
+            te_headers = [h[2] for h in self._index.get('transfer-encoding', ())]
             encodings = [value.lower().strip() for header in te_headers for value in header.split(';')]
             self._chunked = False
             if len(encodings) > 0:
@@ -140,26 +188,46 @@ class HTTPHeaders(object):
         return self._chunked
     
     def get_content_length(self):
-        if self._content_length == None:
-            if any(h[0] == 'transfer-encoding' for h in self._headers):
+        if self._content_length is _unknown:
+            if 'transfer-encoding' in self._index:
                 return None
-            cl_headers = [h[2] for h in self._headers if h[0] == 'content-length']
+            content_length = None
+            cl_headers = [h[2] for h in self._index.get('content-length', ())]
             if len(cl_headers) == 1:
                 try:
-                    self._content_length = int(cl_headers[0].strip())
+                    content_length = int(cl_headers[0].strip())
                 except ValueError:
                     raise HTTPSyntaxError('Invalid Content-Length')
             elif len(cl_headers) > 1:
                 raise HTTPSyntaxError('Too many Content-Length headers')
+            self._content_length = content_length
         return self._content_length
     
+    @property
+    def uri(self):
+        return self._uri
+    
+    @uri.setter
+    def uri(self, uri):
+        self._uri = uri
+        self._url = None
+        self._args = None
+    
+    @property
+    def url(self):
+        if self._url == None:
+            self._url = urlparse(self._uri)
+        return self._url
+    
     @property
     def path(self):
-        return urlparse(self.uri).path
+        return self.url.path
     
     @property
     def args(self):
-        return parse_qs(urlparse(self.uri).query)
+        if self._args == None:
+            self._args = parse_qs(self.url.query)
+        return self._args
     
     def set_cookie(self, name, value, expires, secure, httponly, path = '/'):
         assert self.type == 'response'
@@ -185,23 +253,30 @@ class HTTPHeaders(object):
         self.add('Set-Cookie', cookie_str)
         log.debug('Set-Cookie: {}', cookie_str)
     
-    def get_cookie(self, name):
+    @property
+    def cookies(self):
         assert self.type == 'request'
-        cookie_values = []
-        for h in self._headers:
-            if h[0] == 'cookie':
-                cookies = [c.split('=') for c in h[2].split(';')]
-                cookie_values.extend(c[1].strip() for c in cookies if c[0].strip().lower() == name.lower())
-        return cookie_values
+        if self._cookies == None:
+            self._cookies = {}
+            for h in self._index.get('cookie', ()):
+                for cookie in h[2].split(';'):
+                    name, _, value = cookie.partition('=')
+                    self._cookies.setdefault(name.strip().lower(), []).append(value.strip())
+        return self._cookies
+    
+    def get_cookie(self, name):
+        return list(self.cookies.get(name.lower(), ()))
     
     def delete_cookie(self, name):
         if self.type == 'request':
-            for h in self._headers:
-                if h[0] == 'cookie':
-                    cookies = [c.split('=') for c in h[2].split(';')]
-                    cookies = [c for c in cookies if c[0].strip().lower() != name.lower()]
-                    h[2] = ';'.join('='.join(c) for c in cookies)
-            self._headers = [h for h in self._headers if not (h[0] == 'cookie' and len(h[2]) == 0)]
-        else:
-            self._headers = [h for h in self._headers if not (h[0] == 'set-cookie' and h[2].split('=',1)[0].strip().lower() == name.lower())]
-    
+            if 'cookie' not in self._index:
+                return
+            for h in self._index['cookie']:
+                cookies = [c.split('=') for c in h[2].split(';')]
+                cookies = [c for c in cookies if c[0].strip().lower() != name.lower()]
+                h[2] = ';'.join('='.join(c) for c in cookies)
+            self._updated('cookie')
+            self._remove_entries('cookie', [h for h in self._index['cookie'] if len(h[2]) == 0])
+        elif 'set-cookie' in self._index:
+            self._remove_entries('set-cookie', [h for h in self._index['set-cookie'] if h[2].split('=',1)[0].strip().lower() == name.lower()])
+
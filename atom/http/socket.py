@@ -1,104 +1,180 @@
-from urlparse import parse_qs
+import time
 
-from gevent import Timeout
+from gevent.socket import SHUT_WR
 
-from atom.http.exceptions import HTTPConnectionClosedError, HTTPSyntaxError, HTTPTimeoutError
+from atom.http.buffer import ReceiveBuffer
+from atom.http.deadline import Deadline, Timeouts
+from atom.http.exceptions import HTTPConnectionClosedError, HTTPSyntaxError, HTTPTimeoutError, HTTPBodyTooLargeError
+from atom.http.forms import DEFAULT_FORM_LIMITS, parse_form
 from atom.http.headers import HTTPHeaders
+from atom.http.splice import HAVE_SPLICE, splice
 
 MAX_LINE_LENGTH = 8192
 MAX_NUM_HEADERS = 100
-RECV_BUFFER_SIZE = 4096
 RECV_TIMEOUT = 60*60 # TODO 1 hour.. is this a good value?
+SPLICE_MIN_SIZE = 65536 # smaller bodies aren't worth the extra pipe and syscalls
+COALESCE_SIZE = 16384 # pieces smaller than this are gathered into one send
 # TODO do I need a SEND_TIMEOUT?
 
+# Without anything more specific, any one wait for data may take an hour
+DEFAULT_TIMEOUTS = Timeouts(header = RECV_TIMEOUT, body_idle = RECV_TIMEOUT)
+
 class HTTPSocket(object):
-    def __init__(self, sock, type_):
+    def __init__(self, sock, type_, timeouts = DEFAULT_TIMEOUTS):
         assert type_ in ('server','client')
         self.type = type_
+        self.timeouts = timeouts
         self._sock = sock
-        self._buf = ''
+        self._buf = ReceiveBuffer(sock)
+        self._deadline = Deadline()
+        self._expires = None
+        self._idle = None
         self._headers_sent = False
+        self._expect_continue = False
+        self._saved = False
+        self._out = bytearray()
     
     def save(self, file_obj):
-        recv, sendall = self._sock.recv, self._sock.sendall
+        recv_into, sendall = self._sock.recv_into, self._sock.sendall
         
-        def recv_hook(size):
-            data = recv(size)
-            file_obj.write('recv:\n|{}|\n'.format(data))
-            return data
+        def recv_into_hook(buf, size = 0):
+            size = recv_into(buf, size)
+            file_obj.write('recv:\n|{}|\n'.format(buf[:size].tobytes()))
+            return size
         
         def sendall_hook(data):
-            file_obj.write('send:\n|{}|\n'.format(data))
+            logged = data.tobytes() if isinstance(data, memoryview) else data
+            file_obj.write('send:\n|{}|\n'.format(logged))
             return sendall(data)
         
-        self._sock.recv = recv_hook
+        self._sock.recv_into = recv_into_hook
         self._sock.sendall = sendall_hook
+        self._saved = True
+    
+    def _recv(self):
+        # Waits no later than the current message's deadline, or for no
+        # longer than the idle budget while reading a body
+        expires = self._expires
+        if self._idle != None:
+            expires = _earliest(expires, time.time() + self._idle)
+        self._fill(expires)
+    
+    def _fill(self, expires):
+        if expires != None:
+            self._deadline.arm(expires, HTTPTimeoutError)
+        try:
+            size = self._buf.fill()
+        finally:
+            if expires != None:
+                self._deadline.cancel()
+        if size == 0:
+            raise HTTPConnectionClosedError()
+    
+    def wait_readable(self, timeout):
+        # Waits for more data to arrive, such as the next request on an idle
+        # connection. Returns False if none came within timeout.
+        if len(self._buf) > 0:
+            return True
+        try:
+            self._fill(_after(time.time(), timeout))
+        except HTTPTimeoutError:
+            return False
+        return True
     
     def _read_line(self):
         while True:
-            try:
-                line, self._buf = self._buf.split(b'\r\n',1)
-            except ValueError:
-                if len(self._buf) > MAX_LINE_LENGTH:
-                    raise HTTPSyntaxError('Line too long')
-                with Timeout(RECV_TIMEOUT, HTTPTimeoutError()):
-                    data = self._sock.recv(RECV_BUFFER_SIZE)
-                if len(data) == 0:
-                    raise HTTPConnectionClosedError()
-                self._buf += data
-            else:
+            pos = self._buf.find(b'\r\n')
+            if pos != -1:
+                line = self._buf.read(pos)
+                self._buf.skip(2)
                 return line
+            if len(self._buf) > MAX_LINE_LENGTH:
+                raise HTTPSyntaxError('Line too long')
+            self._recv()
     
     def _read_bytes(self, size):
-        while True:
-            if len(self._buf) > 0:
-                piece, self._buf = self._buf[:size], self._buf[size:]
-                yield piece
-                size -= len(piece)
-                if size == 0:
-                    return
-            with Timeout(RECV_TIMEOUT, HTTPTimeoutError()):
-                data = self._sock.recv(RECV_BUFFER_SIZE)
-            if len(data) == 0:
-                raise HTTPConnectionClosedError()
-            self._buf += data
+        # Pieces are views into the receive buffer and are only valid until
+        # the generator is resumed
+        while size > 0:
+            if len(self._buf) == 0:
+                self._recv()
+            piece = self._buf.take(size)
+            yield piece
+            size -= len(piece)
     
     def _read_all(self):
-        yield self._buf
+        # Ends when the peer closes; every wait for more is bounded like any
+        # other read
         while True:
-            data = self._sock.recv(RECV_BUFFER_SIZE)
-            if len(data) == 0:
-                return
-            yield data
-        
-        
-    def read_headers(self):
-        header_type = 'request' if self.type == 'server' else 'response'
-        
-        line = self._read_line()
+            if len(self._buf) == 0:
+                try:
+                    self._recv()
+                except HTTPConnectionClosedError:
+                    return
+            yield self._buf.take(len(self._buf))
+    
+    @property
+    def buffered(self):
+        return len(self._buf)
+    
+    @property
+    def read_until_close(self):
+        # True if the body being read is only delimited by the connection closing
+        return self._has_body and not self._chunked and self._content_length == None
+    
+    def _read_header_block(self, header_type):
         if header_type == 'request':
-            while line == '':
-                line = self._read_line()
+            # Ignore empty lines before the request line
+            while len(self._buf) < 2 or self._buf.startswith(b'\r\n'):
+                if len(self._buf) < 2:
+                    self._recv()
+                else:
+                    self._buf.skip(2)
         
-        lines = []
-        for _ in xrange(MAX_NUM_HEADERS):
-            lines.append(line)
-            line = self._read_line()
-            if line == '':
+        # Look for the blank line ending the block, keeping count of complete
+        # lines and the length of the partial one so that the limits apply
+        # before the whole block has arrived
+        num_lines, counted = 0, 0
+        while True:
+            end = self._buf.find(b'\r\n\r\n')
+            if end != -1:
                 break
-        else:
+            num_lines += self._buf.count(b'\r\n', counted)
+            counted = max(len(self._buf) - 1, 0)
+            if num_lines > MAX_NUM_HEADERS:
+                raise HTTPSyntaxError('Too many headers')
+            last = self._buf.rfind(b'\r\n')
+            if len(self._buf) - (last + 2 if last != -1 else 0) > MAX_LINE_LENGTH:
+                raise HTTPSyntaxError('Line too long')
+            self._recv()
+        
+        lines = self._buf.read(end).split(b'\r\n')
+        self._buf.skip(4)
+        if len(lines) > MAX_NUM_HEADERS:
             raise HTTPSyntaxError('Too many headers')
+        if end > MAX_LINE_LENGTH and max(map(len, lines)) > MAX_LINE_LENGTH:
+            raise HTTPSyntaxError('Line too long')
+        return lines
+    
+    def read_headers(self):
+        header_type = 'request' if self.type == 'server' else 'response'
         
-        headers = HTTPHeaders.parse(header_type, lines)
+        # The header block has to arrive within its own budget and the
+        # message as a whole within the request budget
+        now = time.time()
+        message_expires = _after(now, self.timeouts.request)
+        self._expires = _earliest(message_expires, _after(now, self.timeouts.header))
+        self._idle = None
+        headers = HTTPHeaders.parse(header_type, self._read_header_block(header_type))
+        self._expires, self._idle = message_expires, self.timeouts.body_idle
         
-        #self._expect_continue = False
-        #if type_ == 'request' and auto_continue and \
-        #        headers.get_single('Expect') == '100-continue':
-        #    self._expect_continue = True
+        self._chunked = headers.get_chunked()
+        self._content_length = headers.get_content_length()
+        self._content_type = headers.get_single('Content-Type')
         
         self._has_body = True
         if header_type == 'request':
-            if not headers.get_chunked() and not headers.get_content_length():
+            if not self._chunked and not self._content_length:
                 self._has_body = False
         else:
             if self._sent_method.upper() == b'HEAD':
@@ -108,25 +184,45 @@ class HTTPSocket(object):
             if headers.code == 204 or headers.code == 304:
                 self._has_body = False
         
-        self._chunked = headers.get_chunked()
-        self._content_length = headers.get_content_length()
-        self._content_type = headers.get_single('Content-Type')
+        # A client sending Expect: 100-continue holds the body back until it
+        # is told to go ahead, which happens when the body is first read
+        self._expect_continue = header_type == 'request' and self._has_body and \
+            headers.has_token('Expect', '100-continue')
+        
         return headers
     
-    def send_headers(self, headers):
-        self._sock.sendall(headers.raw)
+    @property
+    def expect_continue(self):
+        # True while a client is waiting for 100 Continue before sending
+        return self._expect_continue
+    
+    def send_continue(self):
+        if self._expect_continue:
+            self._expect_continue = False
+            self.send_interim(HTTPHeaders.response(100))
+    
+    def send_interim(self, headers):
+        # A 1xx response, which comes ahead of the real one
+        self._write(headers.raw)
+        self.flush()
+    
+    def send_headers(self, headers, more = False):
+        # With more, the headers are held back to go out with the start of
+        # the body
+        self._write(headers.raw)
+        if not more:
+            self.flush()
         
+        # Once answered, a client still holding its body back never sends it
         self._headers_sent = True
+        self._expect_continue = False
         self._sent_chunked = headers.get_chunked()
         
         if headers.type == 'request':
             self._sent_method = headers.method
     
     def read_body(self, raw=False):
-        #if self._expect_continue:
-        #    # TODO what if they call send_headers first?
-        #    self.send_headers(HTTPHeaders.response(100))
-        #    self._expect_continue = False
+        self.send_continue()
         
         if not self._has_body:
             yield ''
@@ -142,11 +238,12 @@ class HTTPSocket(object):
             for data in self._read_all():
                 yield data
     
-    def read_form_body(self):
-        if self._content_type == b'application/x-www-form-urlencoded':
-            return parse_qs(''.join(self.read_body()))
-        else:
-            raise NotImplementedError()
+    def read_form_body(self, limits = DEFAULT_FORM_LIMITS):
+        # Parsed as it arrives, so memory use stays within the limits
+        if self._content_length != None and limits.max_size != None and \
+                self._content_length > limits.max_size:
+            raise HTTPBodyTooLargeError('Form body too large')
+        return parse_form(self._content_type, self.read_body(), limits)
     
     def _read_chunked_body(self, raw):
         while True:
@@ -175,17 +272,86 @@ class HTTPSocket(object):
                         break
                 break
     
-    def send_body(self, data, raw=False):
-        if not raw and self._sent_chunked:
-            raise NotImplementedError()
+    def send_body(self, data, raw = False, more = False):
+        # data is a string, a memoryview or an iterable of them. Unless raw,
+        # a chunked body is framed here and terminated once no more is to
+        # follow. Small pieces are gathered and sent together when enough
+        # have built up or the caller is done.
+        chunked = not raw and self._sent_chunked
+        for d in ((data,) if isinstance(data, (str, memoryview)) else data):
+            if not chunked:
+                self._write(d)
+            elif len(d) > 0:
+                self._write(b'%x\r\n' % len(d))
+                self._write(d)
+                self._write(b'\r\n')
+        if chunked and not more:
+            self._write(b'0\r\n\r\n')
+        if not more:
+            self.flush()
         
-        if isinstance(data, str):
+        self._headers_sent = False
+    
+    def _write(self, data):
+        # Views into a receive buffer don't outlive the caller's loop, so
+        # small ones are copied into the output buffer and large ones are
+        # sent straight away
+        if len(data) >= COALESCE_SIZE:
+            self.flush()
             self._sock.sendall(data)
-        else:
-            for d in data:
-                self._sock.sendall(d)
+            return
+        self._out += data
+        if len(self._out) >= COALESCE_SIZE:
+            self.flush()
+    
+    def flush(self):
+        # The buffer is handed over rather than cleared, so an in-memory
+        # peer can queue it without a copy
+        if self._out:
+            out, self._out = self._out, bytearray()
+            self._sock.sendall(out)
+    
+    def relay_body(self, dest):
+        # Passes the body on to another HTTPSocket unchanged and returns its
+        # size. Content-Length bodies between two real sockets are moved by
+        # the kernel once the part already received has been sent.
+        self.send_continue()
+        if not self._can_splice(dest):
+            return self._relay(self.read_body(raw = True), dest)
         
-        self._headers_sent = False
+        size = self._content_length
+        if len(self._buf) > 0:
+            piece = self._buf.take(size)
+            dest.send_body(piece, raw = True)
+            size -= len(piece)
+        dest.flush()
+        splice(self._sock, dest._sock, size, self.timeouts.body_idle, self._expires)
+        dest._headers_sent = False
+        return self._content_length
+    
+    def relay_all(self, dest):
+        # Copies everything up to the peer closing, as for a tunnel, then
+        # shuts down the sending side of dest. A tunnel lasts as long as it
+        # is in use, so only the body_idle budget applies.
+        self._expires, self._idle = None, self.timeouts.body_idle
+        relayed = self._relay(self._read_all(), dest)
+        dest.shutdown()
+        return relayed
+    
+    def _relay(self, pieces, dest):
+        # Anything gathered goes out whenever no more input is at hand
+        relayed = 0
+        for data in pieces:
+            dest.send_body(data, raw = True, more = len(self._buf) > 0)
+            relayed += len(data)
+        dest.flush()
+        return relayed
+    
+    def _can_splice(self, dest):
+        return HAVE_SPLICE and self._has_body and not self._chunked and \
+            self._content_length >= SPLICE_MIN_SIZE and \
+            not self._saved and not dest._saved and \
+            hasattr(self._sock, 'fileno') and hasattr(dest._sock, 'fileno')
     
     def error_close(self):
         if self.type == 'server' and not self._headers_sent:
@@ -194,8 +360,23 @@ class HTTPSocket(object):
             self.send_headers(response)
         self.close()
     
+    def release(self):
+        # Called once a response has been read in full; plain sockets are
+        # simply closed but pooled connections may be reused
+        self.close()
+    
+    def shutdown(self):
+        self._sock.shutdown(SHUT_WR)
+    
     def close(self):
+        self._deadline.cancel()
         self._sock.close()
 
 
+def _after(now, seconds):
+    return now + seconds if seconds != None else None
 
+def _earliest(a, b):
+    if a == None or b == None:
+        return b if a == None else a
+    return min(a, b)
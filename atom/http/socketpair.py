@@ -1,11 +1,21 @@
+import errno
+from collections import deque
+
 from gevent.event import Event
+from gevent.socket import error, SHUT_RD, SHUT_WR
 
 from atom.http.socket import HTTPSocket
 
-FAKESOCKET_BUFFER_SIZE = 8192
+MEMORY_SOCKET_HIGH_WATER = 65536
+MEMORY_SOCKET_LOW_WATER = 16384
+
+def memory_socket_pair(high_water = MEMORY_SOCKET_HIGH_WATER, low_water = MEMORY_SOCKET_LOW_WATER):
+    a, b = MemorySocket(high_water, low_water), MemorySocket(high_water, low_water)
+    a._peer, b._peer = b, a
+    return a, b
 
 def http_socket_pair():
-    client, server = FakeSocketPair()
+    client, server = memory_socket_pair()
     return HTTPSocket(client, 'client'), HTTPSocket(server, 'server')
 
 
@@ -20,54 +30,131 @@ class LoggingSocket(object):
         self._file.flush()
         return data
     
+    def recv_into(self, buf, size = 0):
+        size = self._sock.recv_into(buf, size)
+        self._file.write('recv:\n|{}|\n'.format(buf[:size].tobytes()))
+        self._file.flush()
+        return size
+    
     def sendall(self, data):
-        self._file.write('send:\n|{}|\n'.format(data))
+        logged = data.tobytes() if isinstance(data, memoryview) else data
+        self._file.write('send:\n|{}|\n'.format(logged))
         self._file.flush()
         return self._sock.sendall(data)
     
+    def shutdown(self, how):
+        self._sock.shutdown(how)
+    
     def close(self):
         self._sock.close()
 
 
-class FakeSocketPair(object):
-    def __new__(cls):
-        a, b = object.__new__(cls), object.__new__(cls)
-        a._other = b
-        b._other = a
-        a._buf = ''
-        b._buf = ''
-        a._read = Event()
-        b._read = Event()
-        a._wrote = Event()
-        b._wrote = Event()
-        a._closed = False
-        b._closed = False
-        return a, b
+class MemorySocket(object):
+    # One end of an in-memory stream. Sent strings are queued on the peer by
+    # reference rather than copied; a sender blocks once the peer has
+    # high_water bytes queued, until its reader gets them down to low_water.
+    
+    def __init__(self, high_water = MEMORY_SOCKET_HIGH_WATER, low_water = MEMORY_SOCKET_LOW_WATER):
+        self.high_water = high_water
+        self.low_water = low_water
+        self._peer = None
+        self._queue = deque()
+        self._queued = 0
+        self._offset = 0 # into the first queued string
+        self._readable = Event()
+        self._writable = Event()
+        self._writable.set()
+        self._eof = False
+        self._shut_rd = False
+        self._shut_wr = False
+        self._closed = False
     
     def recv(self, size):
-        while not self._closed and len(self._buf) == 0:
-            self._wrote.wait()
-            self._wrote.clear()
-        data, self._buf = self._buf[:size], self._buf[size:]
-        self._read.set()
-        return data
+        if not self._wait_readable():
+            return b''
+        data = self._queue[0]
+        if self._offset == 0 and len(data) <= size:
+            self._queue.popleft()
+        else:
+            data = data[self._offset:self._offset+size]
+            self._advance(len(data))
+        self._consumed(len(data))
+        return bytes(data)
+    
+    def recv_into(self, buf, size = 0):
+        size = size or len(buf)
+        if not self._wait_readable():
+            return 0
+        received = 0
+        while self._queue and received < size:
+            data = memoryview(self._queue[0])
+            n = min(size - received, len(data) - self._offset)
+            buf[received:received+n] = data[self._offset:self._offset+n]
+            self._advance(n)
+            received += n
+        self._consumed(received)
+        return received
+    
+    def _wait_readable(self):
+        while not self._queue:
+            if self._eof or self._closed:
+                return False
+            self._readable.clear()
+            self._readable.wait()
+        return True
+    
+    def _advance(self, size):
+        self._offset += size
+        if self._offset == len(self._queue[0]):
+            self._queue.popleft()
+            self._offset = 0
+    
+    def _consumed(self, size):
+        self._queued -= size
+        if self._queued <= self.low_water:
+            self._writable.set()
     
     def sendall(self, data):
-        while len(data) > 0:
-            while not self._closed and len(self._other._buf) >= FAKESOCKET_BUFFER_SIZE:
-                self._other._read.wait()
-                self._other._read.clear()
-            if self._closed:
-                return
-            size = min(len(data), FAKESOCKET_BUFFER_SIZE-len(self._other._buf))
-            piece, data = data[:size], data[size:]
-            self._other._buf += piece
-            self._other._wrote.set()
+        # Views point into buffers the caller goes on to reuse, so they are
+        # copied. Bytearrays are taken over: HTTPSocket only sends the
+        # output buffer it has just given up.
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        
+        peer = self._peer
+        while True:
+            if self._closed or self._shut_wr or peer._closed:
+                raise error(errno.EPIPE, 'Broken pipe')
+            if peer._queued < peer.high_water:
+                break
+            peer._writable.clear()
+            peer._writable.wait()
+        
+        if len(data) > 0 and not peer._shut_rd:
+            peer._queue.append(data)
+            peer._queued += len(data)
+            peer._readable.set()
+    
+    def shutdown(self, how):
+        if how != SHUT_RD:
+            self._shut_wr = True
+            self._peer._eof = True
+            self._peer._readable.set()
+        if how != SHUT_WR:
+            self._shut_rd = self._eof = True
+            self._discard()
     
     def close(self):
+        if self._closed:
+            return
         self._closed = True
-        self._read.set()
-        self._wrote.set()
-        self._other._closed = True
-        self._other._read.set()
-        self._other._wrote.set()
+        self._discard()
+        self._peer._eof = True
+        self._peer._readable.set()
+        self._peer._writable.set()
+    
+    def _discard(self):
+        self._queue.clear()
+        self._queued = self._offset = 0
+        self._readable.set()
+        self._writable.set()
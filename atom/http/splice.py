@@ -0,0 +1,67 @@
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+
+from gevent.socket import error, wait_read, wait_write
+
+from atom.http.exceptions import HTTPConnectionClosedError, HTTPTimeoutError
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+SPLICE_CHUNK_SIZE = 65536
+
+
+def _load_splice():
+    # Python 2 has no os.splice, so call into libc directly. Missing on
+    # anything but Linux, in which case bodies are copied as usual.
+    try:
+        func = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True).splice
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                     ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_splice = _load_splice()
+HAVE_SPLICE = _splice != None
+
+
+def splice(src, dst, size, timeout = None, expires = None):
+    # Moves size bytes from socket src to socket dst through a pipe without
+    # copying them into Python. Both sockets must be non-blocking, as gevent
+    # sockets are. Each wait lasts no longer than timeout, and none goes
+    # past expires.
+    pipe_r, pipe_w = os.pipe()
+    try:
+        while size > 0:
+            moved = _splice_wait(src.fileno(), pipe_w, min(size, SPLICE_CHUNK_SIZE),
+                                 wait_read, src.fileno(), timeout, expires)
+            if moved == 0:
+                raise HTTPConnectionClosedError()
+            size -= moved
+            while moved > 0:
+                moved -= _splice_wait(pipe_r, dst.fileno(), moved,
+                                      wait_write, dst.fileno(), timeout, expires)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+def _splice_wait(fd_in, fd_out, size, wait, wait_fd, timeout, expires):
+    while True:
+        moved = _splice(fd_in, None, fd_out, None, size,
+                        SPLICE_F_MOVE | SPLICE_F_NONBLOCK | SPLICE_F_MORE)
+        if moved >= 0:
+            return moved
+        err = ctypes.get_errno()
+        if err != errno.EAGAIN:
+            raise error(err, os.strerror(err))
+        wait_timeout = timeout
+        if expires != None:
+            remaining = max(0, expires - time.time())
+            wait_timeout = remaining if timeout == None else min(timeout, remaining)
+        wait(wait_fd, timeout = wait_timeout, timeout_exc = HTTPTimeoutError())
@@ -0,0 +1,110 @@
+import time
+import unittest
+
+from gevent import spawn, sleep
+
+from atom.http import HTTPSocket, HTTPTimeoutError, Timeouts, memory_socket_pair
+from atom.http.deadline import Deadline, TimerWheel
+
+RESOLUTION = 0.05
+
+
+class Expired(Exception):
+    pass
+
+
+def run(func):
+    # Runs func in its own greenlet, as the deadlines are armed for the
+    # greenlet that arms them
+    return spawn(func).get(timeout = 5)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(RESOLUTION)
+    
+    def wait_for_expiry(self, deadline, seconds):
+        try:
+            sleep(seconds)
+        except Expired:
+            return True
+        return False
+    
+    def test_fires(self):
+        def func():
+            deadline = Deadline(self.wheel)
+            deadline.arm(time.time() + 0.1, Expired())
+            return self.wait_for_expiry(deadline, 1)
+        self.assertTrue(run(func))
+        self.assertEqual(self.wheel._buckets, {})
+    
+    def test_fires_after_late_runner_start(self):
+        # The hub is held up past the deadline's tick before the wheel's
+        # runner gets to start
+        def func():
+            deadline = Deadline(self.wheel)
+            deadline.arm(time.time() + 0.01, Expired())
+            time.sleep(RESOLUTION * 10)
+            return self.wait_for_expiry(deadline, 1)
+        self.assertTrue(run(func))
+        self.assertEqual(self.wheel._buckets, {})
+    
+    def test_fires_after_stall_while_running(self):
+        def func():
+            other = Deadline(self.wheel)
+            other.arm(time.time() + 10, Expired())
+            sleep(RESOLUTION * 2)
+            deadline = Deadline(self.wheel)
+            deadline.arm(time.time() + 0.01, Expired())
+            time.sleep(RESOLUTION * 10)
+            expired = self.wait_for_expiry(deadline, 1)
+            other.cancel()
+            return expired
+        self.assertTrue(run(func))
+    
+    def test_cancel(self):
+        def func():
+            deadline = Deadline(self.wheel)
+            deadline.arm(time.time() + 0.1, Expired())
+            deadline.cancel()
+            self.assertEqual(self.wheel._buckets, {})
+            return self.wait_for_expiry(deadline, 0.3)
+        self.assertFalse(run(func))
+    
+    def test_moved_later(self):
+        def func():
+            deadline = Deadline(self.wheel)
+            deadline.arm(time.time() + 0.1, Expired())
+            deadline.arm(time.time() + 0.4, Expired())
+            start = time.time()
+            self.assertTrue(self.wait_for_expiry(deadline, 2))
+            return time.time() - start
+        self.assertGreaterEqual(run(func), 0.3)
+
+
+class HTTPSocketTimeoutTest(unittest.TestCase):
+    def test_header_timeout(self):
+        client, server = memory_socket_pair()
+        server = HTTPSocket(server, 'server', Timeouts(header = 0.2))
+        client.sendall('GET / HTTP/1.1\r\nHost: x\r\n')
+        start = time.time()
+        self.assertRaises(HTTPTimeoutError, server.read_headers)
+        self.assertLess(time.time() - start, 2)
+    
+    def test_header_timeout_covers_slow_arrival(self):
+        # Trickling the headers in doesn't extend the budget
+        client, server = memory_socket_pair()
+        server = HTTPSocket(server, 'server', Timeouts(header = 0.5))
+        
+        def trickle():
+            for c in 'GET / HTTP/1.1\r\nHost: x\r\n':
+                client.sendall(c)
+                sleep(0.1)
+        
+        spawn(trickle)
+        start = time.time()
+        self.assertRaises(HTTPTimeoutError, server.read_headers)
+        self.assertLess(time.time() - start, 2)
+
+if __name__ == '__main__':
+    unittest.main()
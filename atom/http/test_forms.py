@@ -0,0 +1,147 @@
+import unittest
+
+from atom.http import FormLimits, FormFile, parse_form, HTTPSyntaxError, HTTPBodyTooLargeError
+
+BOUNDARY = 'b0undary'
+MULTIPART = 'multipart/form-data; boundary=' + BOUNDARY
+URLENCODED = 'application/x-www-form-urlencoded'
+
+
+def multipart(*parts):
+    # parts are (name, value) or (name, value, filename)
+    body = ''
+    for part in parts:
+        body += '--{}\r\nContent-Disposition: form-data; name="{}"'.format(BOUNDARY, part[0])
+        if len(part) > 2:
+            body += '; filename="{}"\r\nContent-Type: text/plain'.format(part[2])
+        body += '\r\n\r\n{}\r\n'.format(part[1])
+    return body + '--{}--\r\n'.format(BOUNDARY)
+
+def split_at(body, *points):
+    points = (0,) + points + (len(body),)
+    return [body[a:b] for a, b in zip(points, points[1:])]
+
+def values(fields):
+    # Files replaced by their contents, so results can be compared
+    result = {}
+    for name, items in fields.iteritems():
+        result[name] = [item.file.read() if isinstance(item, FormFile) else item for item in items]
+    return result
+
+
+class MultipartTest(unittest.TestCase):
+    def test_simple(self):
+        fields = parse_form(MULTIPART, [multipart(('a', '1'), ('b', 'two'))])
+        self.assertEqual(fields, {'a': ['1'], 'b': ['two']})
+    
+    def test_split_at_every_point(self):
+        # However the body is broken up, including inside a delimiter or
+        # its line break, the result is the same
+        body = multipart(('a', 'x\r\n--b0und'), ('f', 'file\r\ndata', 'f.txt'), ('a', '2'))
+        expected = {'a': ['x\r\n--b0und', '2'], 'f': ['file\r\ndata']}
+        for i in xrange(1, len(body)):
+            self.assertEqual(values(parse_form(MULTIPART, split_at(body, i))), expected)
+        for i in xrange(1, len(body) - 7, 7):
+            self.assertEqual(values(parse_form(MULTIPART, split_at(body, i, i + 3, i + 7))), expected)
+    
+    def test_byte_at_a_time(self):
+        body = multipart(('a', '1'), ('f', 'contents', 'f.txt'))
+        self.assertEqual(values(parse_form(MULTIPART, list(body))), {'a': ['1'], 'f': ['contents']})
+    
+    def test_memoryview_pieces(self):
+        body = multipart(('a', '1'))
+        pieces = [memoryview(piece) for piece in split_at(body, 10, 30)]
+        self.assertEqual(parse_form(MULTIPART, pieces), {'a': ['1']})
+    
+    def test_preamble_and_epilogue(self):
+        body = 'preamble\r\n' + multipart(('a', '1')) + 'epilogue'
+        self.assertEqual(parse_form(MULTIPART, [body]), {'a': ['1']})
+    
+    def test_file(self):
+        for spool_size in (0, 4, 1024):
+            fields = parse_form(MULTIPART, [multipart(('f', 'contents', 'f.txt'))],
+                FormLimits(spool_size = spool_size))
+            f = fields['f'][0]
+            self.assertEqual((f.name, f.filename, f.content_type, f.size), ('f', 'f.txt', 'text/plain', 8))
+            self.assertEqual(f.file.read(), 'contents')
+    
+    def test_invalid(self):
+        body = multipart(('a', '1'))
+        cases = [
+            ('multipart/form-data', body),
+            ('multipart/form-data; boundary=' + 'x' * 71, body),
+            (MULTIPART, body[:-8]),
+            (MULTIPART, body.replace('Content-Disposition: form-data; name="a"', 'Content-Type: text/plain')),
+            (MULTIPART, body.replace('form-data; ', 'attachment; ')),
+            (MULTIPART, body.replace('\r\n\r\n', '\r\n', 1)),
+            (MULTIPART, body.replace(BOUNDARY + '\r\n', BOUNDARY + 'junk\r\n', 1)),
+            ('text/plain', body),
+        ]
+        for content_type, body in cases:
+            self.assertRaises(HTTPSyntaxError, parse_form, content_type, [body])
+    
+    def test_files_closed_on_error(self):
+        opened = []
+        original = FormFile.__init__
+        def init(self, *args):
+            original(self, *args)
+            opened.append(self)
+        FormFile.__init__ = init
+        try:
+            body = multipart(('f', 'contents', 'f.txt'), ('g', 'more', 'g.txt'))
+            self.assertRaises(HTTPSyntaxError, parse_form, MULTIPART, [body[:-8]])
+        finally:
+            FormFile.__init__ = original
+        self.assertEqual(len(opened), 2)
+        self.assertTrue(all(f.file.closed for f in opened))
+
+
+class UrlencodedTest(unittest.TestCase):
+    def test_split_at_every_point(self):
+        body = 'a=1&bb=two+words&a=%26'
+        for i in xrange(1, len(body)):
+            fields = parse_form(URLENCODED, split_at(body, i))
+            self.assertEqual(fields, {'a': ['1', '&'], 'bb': ['two words']})
+    
+    def test_empty(self):
+        self.assertEqual(parse_form(URLENCODED, []), {})
+
+
+class LimitsTest(unittest.TestCase):
+    # Every limit raises HTTPBodyTooLargeError, which the router answers
+    # with a 413, whether the body is sent whole or a byte at a time
+    
+    def assertTooLarge(self, content_type, body, **limits):
+        limits = FormLimits(**limits)
+        for pieces in ([body], list(body)):
+            self.assertRaises(HTTPBodyTooLargeError, parse_form, content_type, pieces, limits)
+    
+    def test_max_size(self):
+        self.assertTooLarge(URLENCODED, 'a=' + 'x' * 100, max_size = 50)
+        self.assertTooLarge(MULTIPART, multipart(('f', 'x' * 100, 'f.txt')), max_size = 100)
+    
+    def test_max_field_size(self):
+        self.assertTooLarge(URLENCODED, 'a=' + 'x' * 100, max_field_size = 50)
+        self.assertTooLarge(URLENCODED, 'a=1&b=' + 'x' * 100, max_field_size = 50)
+        self.assertTooLarge(MULTIPART, multipart(('a', 'x' * 100)), max_field_size = 50)
+    
+    def test_max_memory(self):
+        body = '&'.join('a{}={}'.format(i, 'x' * 20) for i in xrange(10))
+        self.assertTooLarge(URLENCODED, body, max_memory = 100)
+        self.assertTooLarge(MULTIPART, multipart(*[('a', 'x' * 20)] * 10), max_memory = 100)
+    
+    def test_max_fields(self):
+        self.assertTooLarge(URLENCODED, '&'.join(['a=1'] * 11), max_fields = 10)
+        self.assertTooLarge(MULTIPART, multipart(*[('f', 'x', 'f.txt')] * 11), max_fields = 10)
+    
+    def test_within_limits(self):
+        limits = FormLimits(max_size = 1000, max_memory = 100, max_field_size = 20, max_fields = 3)
+        fields = parse_form(URLENCODED, ['a=1&b=' + 'x' * 20 + '&c=3'], limits)
+        self.assertEqual(fields, {'a': ['1'], 'b': ['x' * 20], 'c': ['3']})
+    
+    def test_part_headers_too_long(self):
+        body = multipart(('a', '1')).replace('name="a"', 'name="a"; x="' + 'x' * 10000 + '"')
+        self.assertRaises(HTTPSyntaxError, parse_form, MULTIPART, list(body))
+
+if __name__ == '__main__':
+    unittest.main()
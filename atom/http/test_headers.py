@@ -0,0 +1,101 @@
+import unittest
+
+from gevent import Timeout, spawn, sleep
+
+from atom.http import HTTPSocket, HTTPHeaders, HTTPSyntaxError, Timeouts, memory_socket_pair
+from atom.http.socket import MAX_LINE_LENGTH, MAX_NUM_HEADERS
+
+REQUEST = 'GET /path?a=1 HTTP/1.1\r\nHost: example.com\r\nX-Folded: one\r\n  two\r\nX-Spaces:  kept as is \r\n\r\n'
+TEST_TIMEOUT = 5
+
+
+def server_socket(pieces):
+    # An HTTPSocket reading pieces sent one at a time, with nothing after
+    client, server = memory_socket_pair()
+    
+    def send():
+        for piece in pieces:
+            client.sendall(piece)
+            sleep(0)
+    
+    spawn(send)
+    return HTTPSocket(server, 'server', Timeouts(header = TEST_TIMEOUT))
+
+def read(pieces):
+    return server_socket(pieces).read_headers()
+
+def header_lines(count):
+    return ''.join('X-Header-{}: {}\r\n'.format(i, i) for i in xrange(count))
+
+
+class ReadHeadersTest(unittest.TestCase):
+    def assertParsed(self, request):
+        self.assertEqual((request.method, request.uri, request.path), ('GET', '/path?a=1', '/path'))
+        self.assertEqual(request.get_single('Host'), 'example.com')
+        self.assertEqual(request.get_single('X-Folded'), 'one\r\n  two')
+        self.assertEqual(request.raw, REQUEST)
+    
+    def test_whole(self):
+        self.assertParsed(read([REQUEST]))
+    
+    def test_split_at_every_point(self):
+        for i in xrange(1, len(REQUEST)):
+            self.assertParsed(read([REQUEST[:i], REQUEST[i:]]))
+    
+    def test_byte_at_a_time(self):
+        self.assertParsed(read(list(REQUEST)))
+    
+    def test_leading_blank_lines(self):
+        self.assertParsed(read(['\r\n\r\n', REQUEST]))
+    
+    def test_pipelined(self):
+        sock = server_socket([REQUEST * 3])
+        for _ in xrange(3):
+            self.assertParsed(sock.read_headers())
+    
+    def test_framing(self):
+        request = read(['POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello'])
+        self.assertEqual((request.get_content_length(), request.get_chunked()), (5, False))
+        request = read(['POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'])
+        self.assertEqual((request.get_content_length(), request.get_chunked()), (None, True))
+    
+    def test_invalid(self):
+        for block in ['GET /\r\n\r\n', 'GET / HTTP/2.0\r\n\r\n', 'GET / HTTP/1.1\r\nNo colon\r\n\r\n',
+                      'GET / HTTP/1.1\r\n folded first\r\n\r\n',
+                      'GET / HTTP/1.1\r\nContent-Length: 1\r\nContent-Length: 2\r\n\r\n',
+                      'GET / HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                      'GET / HTTP/1.1\r\nTransfer-Encoding: chunked; gzip\r\n\r\n']:
+            self.assertRaises(HTTPSyntaxError, read, [block])
+
+
+class HeaderLimitsTest(unittest.TestCase):
+    # Blocks over the limits are refused with HTTPSyntaxError, which ends
+    # the connection. Ones that never finish are refused as soon as they
+    # pass a limit rather than waiting for the rest or for the timeout.
+    
+    def assertRefused(self, pieces):
+        sock = server_socket(pieces)
+        with Timeout(TEST_TIMEOUT / 2.0, AssertionError('still reading')):
+            self.assertRaises(HTTPSyntaxError, sock.read_headers)
+    
+    def test_within_limits(self):
+        request = read(['GET / HTTP/1.1\r\n' + header_lines(MAX_NUM_HEADERS - 1) + '\r\n'])
+        self.assertEqual(request.get_single('X-Header-0'), '0')
+        request = read(['GET / HTTP/1.1\r\nX: ' + 'x' * (MAX_LINE_LENGTH - 3) + '\r\n\r\n'])
+        self.assertEqual(len(request.get_single('X')), MAX_LINE_LENGTH - 3)
+    
+    def test_too_many_headers(self):
+        block = 'GET / HTTP/1.1\r\n' + header_lines(MAX_NUM_HEADERS + 1)
+        self.assertRefused([block + '\r\n'])
+        self.assertRefused([block])
+        self.assertRefused(list(block))
+    
+    def test_line_too_long(self):
+        line = 'X: ' + 'x' * MAX_LINE_LENGTH
+        self.assertRefused(['GET / HTTP/1.1\r\n' + line + '\r\nHost: x\r\n\r\n'])
+        self.assertRefused(['GET / HTTP/1.1\r\n' + line])
+        self.assertRefused(['GET / ' + 'x' * MAX_LINE_LENGTH])
+        self.assertRefused(['GET / HTTP/1.1\r\n', line[:5000], line[5000:]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import time
+
+from gevent import socket
+
+from atom.http import HTTPHeaders
+
+MAX_CONNECTIONS = 5000
+MAX_CONNECTIONS_PER_IP = 100
+RETRY_AFTER = 5
+REJECT_DRAIN_TIME = 1
+REJECT_DRAIN_SIZE = 65536
+
+
+class AdmissionControl(object):
+    # Counts open client connections, overall and per remote address, and
+    # turns away those over either limit with a 503 serialized up front so
+    # that shedding load costs next to nothing
+    
+    def __init__(self, max_connections = MAX_CONNECTIONS,
+                 max_per_ip = MAX_CONNECTIONS_PER_IP, retry_after = RETRY_AFTER):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.active = 0
+        self.peak = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.rejected_per_ip = 0
+        self._per_ip = {}
+        
+        response = HTTPHeaders.response(503)
+        response.set('Retry-After', str(retry_after))
+        response.set('Content-Length', '0')
+        response.set('Connection', 'close')
+        response.set('Server', 'atom/0.0')
+        self._busy = response.raw
+    
+    def admit(self, ip):
+        count = self._per_ip.get(ip, 0)
+        if self.max_connections != None and self.active >= self.max_connections:
+            self.rejected += 1
+            return False
+        if self.max_per_ip != None and count >= self.max_per_ip:
+            self.rejected_per_ip += 1
+            return False
+        
+        self._per_ip[ip] = count + 1
+        self.active += 1
+        self.accepted += 1
+        self.peak = max(self.peak, self.active)
+        return True
+    
+    def release(self, ip):
+        self.active -= 1
+        count = self._per_ip[ip] - 1
+        if count:
+            self._per_ip[ip] = count
+        else:
+            del self._per_ip[ip]
+    
+    def reject(self, sock):
+        # Closing with the request still unread makes the kernel reset the
+        # connection, and the client may never see the 503, so a little of
+        # whatever it sends is read and dropped first
+        try:
+            sock.sendall(self._busy)
+            sock.shutdown(socket.SHUT_WR)
+            expires = time.time() + REJECT_DRAIN_TIME
+            drained = 0
+            while drained < REJECT_DRAIN_SIZE:
+                remaining = expires - time.time()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                data = sock.recv(8192)
+                if not data:
+                    break
+                drained += len(data)
+        except socket.error:
+            pass
+        sock.close()
+    
+    def stats(self):
+        return [
+            ('pid', os.getpid()),
+            ('active', self.active),
+            ('peak', self.peak),
+            ('remote_addresses', len(self._per_ip)),
+            ('accepted', self.accepted),
+            ('rejected', self.rejected),
+            ('rejected_per_ip', self.rejected_per_ip),
+            ('max_connections', self.max_connections),
+            ('max_connections_per_ip', self.max_per_ip),
+        ]
@@ -0,0 +1,43 @@
+import random
+
+# Strategies pick one of a module's backends, given their ConnectionPools.
+# Backends that keep failing have already been left out by BackendPool.
+
+
+class RoundRobin(object):
+    def __init__(self):
+        self._next = 0
+    
+    def choose(self, backends):
+        self._next = (self._next + 1) % len(backends)
+        return backends[self._next]
+
+
+class LeastOutstanding(object):
+    # Fewest requests in flight; ties go round in turn so that an idle
+    # module doesn't send everything to its first worker
+    def __init__(self):
+        self._next = 0
+    
+    def choose(self, backends):
+        self._next = (self._next + 1) % len(backends)
+        rotated = backends[self._next:] + backends[:self._next]
+        return min(rotated, key = lambda backend: backend.in_flight)
+
+
+class PowerOfTwo(object):
+    # The less busy of two picked at random, which avoids everyone piling
+    # onto the same least loaded backend
+    def choose(self, backends):
+        if len(backends) == 1:
+            return backends[0]
+        a, b = random.sample(backends, 2)
+        return a if a.in_flight <= b.in_flight else b
+
+
+STRATEGIES = {
+    'round-robin': RoundRobin,
+    'least-outstanding': LeastOutstanding,
+    'power-of-two': PowerOfTwo,
+}
+DEFAULT_STRATEGY = 'least-outstanding'
@@ -0,0 +1,97 @@
+import sqlite3
+
+from gevent import spawn
+from gevent.event import AsyncResult
+from gevent.threadpool import ThreadPool
+
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+STATEMENT_CACHE_SIZE = 256
+
+
+class Database(object):
+    # All SQLite work happens on a single worker thread so a slow query or
+    # fsync only blocks the greenlet waiting for it, never the event loop.
+    # Writes queued while a transaction is running are grouped into the next
+    # one.
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self._thread = ThreadPool(1)
+        self._conn = self._thread.apply(self._connect)
+        self._writes = []
+        self._writer = None
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, check_same_thread = False,
+            isolation_level = None, cached_statements = STATEMENT_CACHE_SIZE)
+        conn.text_factory = str # TODO revisit this in python 3
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+    
+    def query(self, sql, args = ()):
+        return self._thread.apply(self._query, (sql, args))
+    
+    def query_one(self, sql, args = ()):
+        rows = self.query(sql, args)
+        return rows[0] if len(rows) > 0 else None
+    
+    def _query(self, sql, args):
+        return self._conn.execute(sql, args).fetchall()
+    
+    def execute(self, sql, args = (), wait = True):
+        return self._write(sql, args, False, wait)
+    
+    def executemany(self, sql, args, wait = True):
+        return self._write(sql, list(args), True, wait)
+    
+    def _write(self, sql, args, many, wait):
+        # Returns the number of rows changed once the transaction holding the
+        # write has been committed, or nothing if not waiting for it
+        result = AsyncResult()
+        self._writes.append((sql, args, many, result))
+        if not self._writer:
+            self._writer = spawn(self._write_batches)
+        if wait:
+            return result.get()
+    
+    def _write_batches(self):
+        try:
+            while self._writes:
+                batch, self._writes = self._writes, []
+                try:
+                    outcomes = self._thread.apply(self._run_writes, (batch,))
+                except Exception as e:
+                    outcomes = [(None, e)] * len(batch)
+                for (sql, _, _, result), (rowcount, error) in zip(batch, outcomes):
+                    if error:
+                        log.error('Database write failed: {}: {}', sql, error)
+                        result.set_exception(error)
+                    else:
+                        result.set(rowcount)
+        finally:
+            self._writer = None
+    
+    def _run_writes(self, batch):
+        # Runs on the database thread, so it must not touch gevent objects
+        outcomes = []
+        self._conn.execute('BEGIN')
+        for sql, args, many, _ in batch:
+            try:
+                if many:
+                    cursor = self._conn.executemany(sql, args)
+                else:
+                    cursor = self._conn.execute(sql, args)
+                outcomes.append((cursor.rowcount, None))
+            except sqlite3.Error as e:
+                outcomes.append((None, e))
+        
+        try:
+            self._conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            self._conn.execute('ROLLBACK')
+            outcomes = [(None, e)] * len(batch)
+        return outcomes
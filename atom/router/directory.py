@@ -1,13 +1,29 @@
+import time
+
+from collections import OrderedDict
+
+from gevent import socket
+
+from atom.router.routing import RoutingTable
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+AUTHORIZATION_CACHE_SIZE = 10000
+AUTHORIZATION_TTL = 60
+AUTHORIZATION_NEGATIVE_TTL = 10
+CREATE_USERS_TABLE = 'CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT, password TEXT)'
 
 class Directory(object):
     def __init__(self, router):
         self.router = router
+        self.routes = RoutingTable()
+        self.authorizations = AuthorizationCache(AUTHORIZATION_CACHE_SIZE,
+            AUTHORIZATION_TTL, AUTHORIZATION_NEGATIVE_TTL)
     
     def start(self):
         db = self.router.database
-        db.execute(
-            'CREATE TABLE IF NOT EXISTS users (' +
-            'id INTEGER PRIMARY KEY, name TEXT, password TEXT)')
+        db.execute(CREATE_USERS_TABLE)
         db.execute(
             'INSERT OR REPLACE INTO users VALUES (0, ?, ?)', ('system', None))
         
@@ -19,6 +35,38 @@ class Directory(object):
             'CREATE TABLE IF NOT EXISTS hostnames (' +
             'id INTEGER PRIMARY KEY, hostname TEXT UNIQUE, module_id INTEGER)')
         
+        self.reload()
+    
+    def reload(self):
+        # Build the new routing table completely before swapping it in, so
+        # requests never see a partial one
+        db = self.router.database
+        modules = {}
+        for module_id, name in db.query('SELECT id, name FROM modules'):
+            modules[module_id] = Module(self, module_id, name)
+        
+        routes = RoutingTable()
+        for hostname, module_id in db.query('SELECT hostname, module_id FROM hostnames'):
+            if module_id not in modules:
+                log.error('Hostname {} refers to unknown module {}', hostname, module_id)
+                continue
+            routes.add(hostname, modules[module_id])
+        
+        self.routes = routes
+        self.authorizations.clear()
+    
+    def add_module(self, name):
+        self.router.database.execute('INSERT INTO modules VALUES (NULL, ?)', (name,))
+        self.reload()
+    
+    def set_hostname(self, hostname, module_id):
+        self.router.database.execute(
+            'INSERT OR REPLACE INTO hostnames (hostname, module_id) VALUES (?, ?)', (hostname, module_id))
+        self.reload()
+    
+    def remove_hostname(self, hostname):
+        self.router.database.execute('DELETE FROM hostnames WHERE hostname = ?', (hostname,))
+        self.reload()
     
     def get_users(self):
         pass
@@ -32,21 +80,108 @@ class Directory(object):
     def get_shell_hostname(self, uid):
         return 'home.xvc.cc:8080'
     
-    def check_login(self, username, password):
-        if username == 'shane' and password == 'test':
-            return 1
-        else:
+    def add_user(self, name, password):
+        self.router.database.execute('INSERT INTO users VALUES (NULL, ?, ?)',
+            (name, self.router.passwords.hash(password)))
+        self.authorizations.clear()
+    
+    def set_password(self, uid, password):
+        self.router.database.execute('UPDATE users SET password = ? WHERE id = ?',
+            (self.router.passwords.hash(password), uid))
+    
+    def check_login(self, username, password, remote_ip):
+        # May raise LoginThrottled when too many logins are being checked
+        row = self.router.database.query_one(
+            'SELECT id, password FROM users WHERE name = ?', (username,))
+        uid, stored = row if row else (None, None)
+        if not self.router.passwords.verify(password, stored, remote_ip):
             return None
+        return uid
     
     def check_authorization(self, uid, hostname):
+        # Decisions are cached, refusals for less time than grants. Changes
+        # made through this Directory clear the cache; changes made by other
+        # processes show up once the cached decisions expire.
+        allowed = self.authorizations.get(uid, hostname)
+        if allowed == None:
+            allowed = self._check_authorization(uid, hostname)
+            self.authorizations.add(uid, hostname, allowed)
+        return allowed
+    
+    def _check_authorization(self, uid, hostname):
         return True
     
+    def get_backend(self, hostname, uri):
+        path = uri.split('?',1)[0]
+        module = self.routes.lookup(hostname, path)
+        if not module:
+            return None
+        return module.get_endpoint(path)
+    
     def get_socket(self, hostname, uri):
-        return False
+        address = self.get_backend(hostname, uri)
+        if not address:
+            return False
+        try:
+            return self.router.backends.get(address)
+        except socket.error:
+            # The module may have been stopped since it was last used; look
+            # again, starting it if need be
+            self.router.modules.connect_failed(address)
+            address = self.get_backend(hostname, uri)
+            if not address:
+                return False
+            return self.router.backends.get(address)
+
+class AuthorizationCache(object):
+    # (uid, hostname) -> whether that user may use that hostname, least
+    # recently used evicted first
+    def __init__(self, size, ttl, negative_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._decisions = OrderedDict()
+    
+    def get(self, uid, hostname):
+        key = (uid, hostname)
+        decision = self._decisions.pop(key, None)
+        if not decision or decision[1] < time.time():
+            self.misses += 1
+            return None
+        self._decisions[key] = decision
+        self.hits += 1
+        return decision[0]
+    
+    def add(self, uid, hostname, allowed):
+        ttl = self.ttl if allowed else self.negative_ttl
+        self._decisions.pop((uid, hostname), None)
+        self._decisions[(uid, hostname)] = (allowed, time.time() + ttl)
+        if len(self._decisions) > self.size:
+            self._decisions.popitem(last = False)
+            self.evictions += 1
+    
+    def clear(self):
+        self._decisions.clear()
+    
+    def stats(self):
+        return [
+            ('authorization_cache_size', len(self._decisions)),
+            ('authorization_cache_hits', self.hits),
+            ('authorization_cache_misses', self.misses),
+            ('authorization_cache_evictions', self.evictions),
+        ]
 
 class Module(object):
+    def __init__(self, directory, id_, name):
+        self.directory = directory
+        self.id = id_
+        self.name = name
+    
     def get_endpoint(self, path):
-        pass
+        return self.directory.router.modules.choose(self.name)
 
 class User(object):
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,36 @@
+from atom.http import HTTPHeaders
+from atom.http.forms import DEFAULT_FORM_LIMITS
+
+
+class Response(object):
+    # What an in-process handler returns; the router sends it on like any
+    # other response
+    def __init__(self, code, body = '', content_type = None):
+        self.headers = HTTPHeaders.response(code)
+        self.body = body
+        if content_type:
+            self.headers.set('Content-Type', content_type)
+        self.headers.set('Content-Length', str(len(body)))
+
+
+class RequestBody(object):
+    # The body of a request handled in-process, read straight off the client
+    # connection. Pieces are only valid until the next one is read. If the
+    # handler leaves it unread the connection can't be reused.
+    def __init__(self, sock, request):
+        self._sock = sock
+        self.complete = not request.get_chunked() and not request.get_content_length()
+    
+    def __iter__(self):
+        if self.complete:
+            return
+        for piece in self._sock.read_body():
+            yield piece
+        self.complete = True
+    
+    def read_form(self, limits = DEFAULT_FORM_LIMITS):
+        if self.complete:
+            return {}
+        form = self._sock.read_form_body(limits)
+        self.complete = True
+        return form
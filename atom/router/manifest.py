@@ -1,5 +1,8 @@
 import os
 import json
+import shlex
+
+from atom.router.balancer import STRATEGIES, DEFAULT_STRATEGY
 
 
 
@@ -30,6 +33,16 @@ class ModuleManifest(object):
                     raise ModuleManifestError('manifest missing "{}" key'.format(key))
             
             self.command = manifest['command']
+            if isinstance(self.command, basestring):
+                self.command = shlex.split(self.command)
+            
+            self.workers = manifest.get('workers', 1)
+            if not isinstance(self.workers, int) or self.workers < 1:
+                raise ModuleManifestError('"workers" must be a positive integer')
+            
+            self.balance = manifest.get('balance', DEFAULT_STRATEGY)
+            if self.balance not in STRATEGIES:
+                raise ModuleManifestError('unknown balancing strategy: {}'.format(self.balance))
 
 class ModuleManifestError(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,111 @@
+import os
+import hmac
+import hashlib
+import multiprocessing
+
+from base64 import b64encode, b64decode
+
+from gevent.threadpool import ThreadPool
+
+from atom.router.supervisor import die_with_parent
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+PASSWORD_WORKERS = 2
+MAX_PENDING_LOGINS = 64
+MAX_LOGINS_PER_IP = 2
+LOGIN_RETRY_AFTER = 1
+PBKDF2_ITERATIONS = 100000
+SALT_SIZE = 16
+
+
+class LoginThrottled(Exception):
+    # Too many passwords are being checked, overall (503) or for one remote
+    # address (429)
+    def __init__(self, code):
+        Exception.__init__(self, 'login throttled ({})'.format(code))
+        self.code = code
+
+
+class PasswordPool(object):
+    # Hashing is deliberately slow, so it runs in a few worker processes
+    # where it can't hold up the hub. A thread per process waits on each
+    # result, the way Database waits on SQLite. Logins over the limits are
+    # refused straight away rather than queued behind everyone else's;
+    # hashing a new password is an administrative job and isn't limited.
+    
+    def __init__(self, processes = PASSWORD_WORKERS, max_pending = MAX_PENDING_LOGINS,
+                 max_per_ip = MAX_LOGINS_PER_IP):
+        self.max_pending = max_pending
+        self.max_per_ip = max_per_ip
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._per_ip = {}
+        self._processes = multiprocessing.Pool(processes, die_with_parent)
+        self._threads = ThreadPool(processes)
+    
+    def hash(self, password):
+        return self._call(hash_password, (password,))
+    
+    def verify(self, password, stored, ip):
+        return self._run(verify_password, (password, stored), ip)
+    
+    def check(self, ip):
+        # Raises LoginThrottled if a login from ip would be refused now, so
+        # the login form needn't be read first
+        if self.max_pending != None and self.pending >= self.max_pending:
+            self.rejected += 1
+            raise LoginThrottled(503)
+        if self.max_per_ip != None and self._per_ip.get(ip, 0) >= self.max_per_ip:
+            self.rejected += 1
+            raise LoginThrottled(429)
+    
+    def _run(self, func, args, ip):
+        self.check(ip)
+        self.pending += 1
+        self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+        try:
+            return self._call(func, args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            count = self._per_ip[ip] - 1
+            if count:
+                self._per_ip[ip] = count
+            else:
+                del self._per_ip[ip]
+    
+    def _call(self, func, args):
+        return self._threads.apply(self._processes.apply, (func, args))
+    
+    def close(self):
+        self._processes.terminate()
+        self._threads.kill()
+
+
+# These run in the worker processes
+
+def hash_password(password, salt = None, iterations = PBKDF2_ITERATIONS):
+    salt = salt or os.urandom(SALT_SIZE)
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return 'pbkdf2_sha256${}${}${}'.format(iterations, b64encode(salt), b64encode(digest))
+
+def verify_password(password, stored):
+    # Without a stored hash the work is still done, so that failing for an
+    # unknown user takes as long as failing for a wrong password
+    if not stored:
+        hash_password(password)
+        return False
+    try:
+        algorithm, iterations, salt, digest = stored.split('$')
+        iterations = int(iterations)
+        salt = b64decode(salt)
+    except (ValueError, TypeError):
+        log.error('Unrecognized password hash')
+        return False
+    if algorithm != 'pbkdf2_sha256':
+        log.error('Unsupported password hash {}', algorithm)
+        return False
+    return hmac.compare_digest(hash_password(password, salt, iterations), stored)
@@ -0,0 +1,197 @@
+import errno
+import select
+import time
+from collections import deque
+
+from gevent import socket, spawn, sleep
+from gevent.lock import Semaphore
+
+from atom.http import HTTPSocket, HTTPError
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+POOL_MAX_CONNECTIONS = 32
+POOL_MAX_IDLE = 8
+POOL_IDLE_TIMEOUT = 60
+POOL_ACQUIRE_TIMEOUT = 5 # how long a request waits for a connection slot
+EJECT_FAILURES = 3
+EJECT_TIME = 10
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+GONE_ERRNOS = frozenset([errno.ECONNREFUSED, errno.ENOENT]) # nothing listening on the socket
+
+
+class BackendBusyError(Exception):
+    # Every connection to a backend stayed in use for POOL_ACQUIRE_TIMEOUT
+    pass
+
+
+class BackendPool(object):
+    def __init__(self, max_connections = POOL_MAX_CONNECTIONS, max_idle = POOL_MAX_IDLE,
+                 idle_timeout = POOL_IDLE_TIMEOUT, acquire_timeout = POOL_ACQUIRE_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._pools = {}
+        spawn(self._evict_idle)
+    
+    def get(self, address, fresh = False):
+        return self._pool(address).get(fresh)
+    
+    def _pool(self, address):
+        if address not in self._pools:
+            self._pools[address] = ConnectionPool(self, address)
+        return self._pools[address]
+    
+    def choose(self, addresses, strategy):
+        # Backends that keep failing are left out for a while, unless that
+        # would leave nothing to choose from
+        pools = [self._pool(address) for address in addresses]
+        now = time.time()
+        healthy = [pool for pool in pools if pool.ejected_until <= now] or pools
+        return strategy.choose(healthy).address
+    
+    def _evict_idle(self):
+        while True:
+            sleep(self.idle_timeout / 2.0)
+            cutoff = time.time() - self.idle_timeout
+            for pool in self._pools.values():
+                pool.evict_idle(cutoff)
+
+
+class ConnectionPool(object):
+    # Idle connections are kept most recently used last, so reuse takes the
+    # warmest one and eviction starts from the oldest. Each connection in use
+    # carries one request, so their number is the backend's load.
+    
+    def __init__(self, manager, address):
+        self.manager = manager
+        self.address = address
+        self.in_flight = 0
+        self.failures = 0
+        self.ejected_until = 0
+        self._idle = deque()
+        self._slots = Semaphore(manager.max_connections)
+    
+    def get(self, fresh = False):
+        if not self._slots.acquire(timeout = self.manager.acquire_timeout):
+            raise BackendBusyError('No free connection to {}'.format(self.address))
+        try:
+            conn = None if fresh else self._get_idle()
+            if not conn:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.address)
+                except socket.error as e:
+                    sock.close()
+                    self.failed(e.errno in GONE_ERRNOS)
+                    raise
+                conn = BackendConnection(self, sock)
+        except socket.error:
+            self._slots.release()
+            raise
+        except Exception as e:
+            # Callers answer 502 for a socket.error, so anything else that
+            # goes wrong here is passed on as one
+            self._slots.release()
+            log.exception('Unable to get a connection to {}', self.address)
+            raise socket.error(str(e))
+        except:
+            self._slots.release()
+            raise
+        
+        conn.in_use = True
+        self.in_flight += 1
+        return conn
+    
+    def succeeded(self):
+        self.failures = 0
+    
+    def failed(self, gone = False):
+        # Once a backend has failed several times in a row it is ejected,
+        # and after that every further failure ejects it again until it
+        # gets something right. One whose worker is gone is ejected at once,
+        # so the retry after a crash goes elsewhere.
+        self.failures += 1
+        if gone or self.failures >= EJECT_FAILURES:
+            if self.ejected_until <= time.time():
+                log.info('Ejecting backend {} after {} failures', self.address, self.failures)
+            self.ejected_until = time.time() + EJECT_TIME
+    
+    def _get_idle(self):
+        while self._idle:
+            conn = self._idle.pop()
+            if conn.is_alive():
+                conn.reused = True
+                return conn
+            log.debug('Discarding stale connection to {}', self.address)
+            conn.close()
+        return None
+    
+    def _checkin(self, conn):
+        if conn.in_use:
+            conn.in_use = False
+            self.in_flight -= 1
+            self._slots.release()
+    
+    def release(self, conn):
+        self._checkin(conn)
+        if conn.reusable and len(self._idle) < self.manager.max_idle:
+            conn.idle_since = time.time()
+            self._idle.append(conn)
+        else:
+            conn.close()
+    
+    def evict_idle(self, cutoff):
+        while self._idle and self._idle[0].idle_since < cutoff:
+            self._idle.popleft().close()
+
+
+class BackendConnection(HTTPSocket):
+    def __init__(self, pool, sock):
+        HTTPSocket.__init__(self, sock, 'client')
+        self.pool = pool
+        self.in_use = False
+        self.reused = False
+        self.reusable = False
+        self.idle_since = None
+    
+    def read_headers(self):
+        # A reused connection the backend has since closed says nothing
+        # about the backend's health
+        try:
+            headers = HTTPSocket.read_headers(self)
+        except (HTTPError, socket.error):
+            if not self.reused:
+                self.pool.failed()
+            raise
+        self.pool.succeeded()
+        self.reusable = not self.read_until_close and not headers.has_token('Connection', 'close')
+        return headers
+    
+    def is_alive(self):
+        # An idle connection has nothing to read unless the backend closed it
+        # or sent something unsolicited, and either way it can't be reused.
+        # This polls, since select can't take descriptors of 1024 or more.
+        if self.buffered:
+            return False
+        try:
+            poll = select.poll()
+            poll.register(self._sock.fileno(), select.POLLIN)
+            return not poll.poll(0)
+        except (select.error, socket.error, ValueError):
+            return False
+    
+    def can_retry(self, request):
+        # A reused connection may have been closed by the backend while it
+        # sat idle. Idempotent requests without a body can safely be resent.
+        return self.reused and request.method in IDEMPOTENT_METHODS and \
+            not request.get_chunked() and not request.get_content_length()
+    
+    def release(self):
+        self.pool.release(self)
+    
+    def close(self):
+        self.pool._checkin(self)
+        HTTPSocket.close(self)
@@ -0,0 +1,82 @@
+import time
+
+from gevent import spawn, joinall, getcurrent, socket
+
+from atom.http import HTTPError
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+
+class DuplexPump(object):
+    # Moves data both ways between two peers, one greenlet per direction.
+    # Each direction sends a piece before reading the next, so no more than
+    # a receive buffer and a send buffer are in flight per direction and a
+    # slow reader stalls its writer instead of growing memory. If either
+    # direction fails the other is killed and on_error is called.
+    
+    def __init__(self, name):
+        self.name = name
+        self.upstream = Direction('upstream')
+        self.downstream = Direction('downstream')
+        self.failed = False
+    
+    def start(self, direction, func, *args):
+        # func does the copying and returns the number of bytes it moved
+        direction.greenlet = spawn(self._run, direction, func, args)
+    
+    def _run(self, direction, func, args):
+        direction.started = time.time()
+        try:
+            direction.bytes = func(*args) or 0
+        except Exception as e:
+            if isinstance(e, (HTTPError, socket.error)):
+                log.info('{} {} failed: {!r}', self.name, direction.name, e)
+            else:
+                log.exception('{} {} failed', self.name, direction.name)
+            direction.failed = self.failed = True
+            self.cancel()
+            self.on_error(direction, e)
+        finally:
+            direction.finished = time.time()
+        log.debug('{} {}: {} bytes in {:.3f}s', self.name, direction.name,
+            direction.bytes, direction.duration)
+    
+    def cancel(self):
+        current = getcurrent()
+        for direction in (self.upstream, self.downstream):
+            if direction.greenlet and direction.greenlet is not current:
+                direction.greenlet.kill(block = False)
+    
+    def join(self):
+        # A direction may be started by the other one, so keep going until
+        # nothing is left running
+        while True:
+            running = [d.greenlet for d in (self.upstream, self.downstream)
+                       if d.greenlet and not d.greenlet.dead]
+            if not running:
+                return
+            joinall(running)
+    
+    def on_error(self, direction, error):
+        pass
+
+
+class Direction(object):
+    def __init__(self, name):
+        self.name = name
+        self.greenlet = None
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+        self.failed = False
+    
+    @property
+    def duration(self):
+        if self.started == None:
+            return 0
+        return (self.finished or time.time()) - self.started
+    
+    def join(self):
+        if self.greenlet:
+            self.greenlet.join()
@@ -1,135 +1,469 @@
-import sqlite3
-
-from gevent import spawn
+from gevent import socket, spawn
+from gevent.pool import Pool
+from gevent.event import Event
 from gevent.server import StreamServer
 
-from atom.http import HTTPSocket, HTTPHeaders, HTTPError
+from atom.http import HTTPSocket, HTTPError, HTTPConnectionClosedError, HTTPSyntaxError, HTTPBodyTooLargeError, Timeouts
+from atom.router.admission import AdmissionControl, MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP, RETRY_AFTER
+from atom.router.database import Database
 from atom.router.directory import Directory
-from atom.router.sessions import SessionManager
+from atom.router.handlers import Response, RequestBody
+from atom.router.passwords import PasswordPool, PASSWORD_WORKERS, MAX_PENDING_LOGINS, MAX_LOGINS_PER_IP
+from atom.router.pool import BackendPool, BackendConnection, BackendBusyError
+from atom.router.pump import DuplexPump
+from atom.router.sessions import SessionManager, SESSION_SWEEP_INTERVAL, SESSION_SWEEP_BATCH_SIZE, SESSION_CACHE_TTL
+from atom.router.supervisor import ModuleSupervisor, ModuleError, MODULE_IDLE_TIMEOUT
+from atom.router.workers import WorkerSupervisor
 from atom.logger import get_logger
 
 log = get_logger(__name__)
 
+HEADER_TIMEOUT = 30
+BODY_TIMEOUT = 60
+REQUEST_TIMEOUT = 60*60
+KEEPALIVE_TIMEOUT = 15
+MAX_KEEPALIVE_REQUESTS = 100
+LISTEN_BACKLOG = 256
+ACCEPT_HEADROOM = 256 # connections being turned away on top of the limit
+EXPECT_CONTINUE_TIMEOUT = 1 # how long a request body waits for a backend's 100 Continue
+STATUS_ADDRESSES = ('127.0.0.1', '::1') # clients allowed to see /+atom/status
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15) # Linux value, Python 2 lacks the constant
+
 class Router(object):
-    def __init__(self, ip, port, apps_dir, run_dir, db_filename):
+    def __init__(self, ip, port, apps_dir, run_dir, db_filename,
+                 workers = 1, reuse_port = False,
+                 session_sweep_interval = SESSION_SWEEP_INTERVAL,
+                 session_sweep_batch_size = SESSION_SWEEP_BATCH_SIZE, session_tokens = False,
+                 header_timeout = HEADER_TIMEOUT, body_timeout = BODY_TIMEOUT,
+                 request_timeout = REQUEST_TIMEOUT, keepalive_timeout = KEEPALIVE_TIMEOUT,
+                 max_keepalive_requests = MAX_KEEPALIVE_REQUESTS,
+                 max_connections = MAX_CONNECTIONS, max_connections_per_ip = MAX_CONNECTIONS_PER_IP,
+                 backlog = LISTEN_BACKLOG, retry_after = RETRY_AFTER, status_addresses = STATUS_ADDRESSES,
+                 module_idle_timeout = MODULE_IDLE_TIMEOUT, password_workers = PASSWORD_WORKERS,
+                 max_pending_logins = MAX_PENDING_LOGINS, max_logins_per_ip = MAX_LOGINS_PER_IP):
         self.secure = False
-        self.database = sqlite3.connect(db_filename)
-        self.database.text_factory = str # TODO revisit this in python 3
+        self.address = (ip, port)
+        self.apps_dir = apps_dir
+        self.run_dir = run_dir
+        self.db_filename = db_filename
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.max_keepalive_requests = max_keepalive_requests
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.retry_after = retry_after
+        self.status_addresses = status_addresses
+        self.module_idle_timeout = module_idle_timeout
+        self.password_workers = password_workers
+        self.max_pending_logins = max_pending_logins
+        self.max_logins_per_ip = max_logins_per_ip
+        self.session_sweep_interval = session_sweep_interval
+        self.session_sweep_batch_size = session_sweep_batch_size
+        self.session_tokens = session_tokens
+        
+        # Limits on how long clients may take, so that a slow or idle client
+        # can only hold a connection for so long. None means no limit.
+        self.timeouts = Timeouts(header = header_timeout, body_idle = body_timeout,
+            request = request_timeout, keepalive = keepalive_timeout)
+        
+        # Workers either inherit one listening socket or each bind their own
+        # with SO_REUSEPORT and let the kernel spread connections
+        self._listener = None if reuse_port else self._listen()
+        
+        # Sessions are cached per process, so with several workers a cached
+        # session is checked against the database again after a while in
+        # case another worker deleted it
+        self._session_cache_ttl = SESSION_CACHE_TTL if workers > 1 else None
+        
+        if workers > 1:
+            WorkerSupervisor(self, workers).run()
+        else:
+            self.serve()
+    
+    def _listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        return sock
+    
+    def serve(self):
+        # Everything holding file descriptors, threads or greenlets is
+        # created here, after any fork. The password workers are forked
+        # first, while this process has no other threads.
+        self.passwords = PasswordPool(self.password_workers,
+            self.max_pending_logins, self.max_logins_per_ip)
+        self.database = Database(self.db_filename)
+        self.backends = BackendPool()
+        self.modules = ModuleSupervisor(self, self.module_idle_timeout)
         self.directory = Directory(self)
-        self.sessions = SessionManager(self)
+        self.directory.start()
+        self.sessions = SessionManager(self, self.session_sweep_interval,
+            self.session_sweep_batch_size, self._session_cache_ttl, self.session_tokens)
+        
+        self.admission = AdmissionControl(self.max_connections,
+            self.max_connections_per_ip, self.retry_after)
         
-        StreamServer((ip, port), self.handle).serve_forever()
+        # Connections over the limits get a 503, but only so many of those
+        # are handled at once; past that accepting stops and new connections
+        # wait in the listen backlog
+        pool = 'default'
+        if self.max_connections != None:
+            pool = Pool(self.max_connections + ACCEPT_HEADROOM)
+        StreamServer(self._listener or self._listen(), self.handle, spawn = pool).serve_forever()
     
     def handle(self, sock, addr):
-        RouterConnection(self, sock, addr)
+        if not self.admission.admit(addr[0]):
+            self.admission.reject(sock)
+            return
+        try:
+            RouterConnection(self, sock, addr)
+        finally:
+            self.admission.release(addr[0])
+    
+    def handle_status(self, request, body):
+        # Counts are per worker process
+        stats = self.admission.stats() + self.directory.authorizations.stats()
+        text = ''.join('{}: {}\n'.format(name, value) for name, value in stats)
+        return Response(200, text, 'text/plain')
 
 
 class RouterConnection(object):
     def __init__(self, router, sock, addr):
-        sock = HTTPSocket(sock, 'server')
+        self.router = router
+        self.addr = addr
+        self.sock = HTTPSocket(sock, 'server', router.timeouts)
+        self._last_response = None
+        self._closed = False
         
         try:
-            while True:
-                headers = sock.read_headers()
-                
-                connection_close = headers.get('Connection') == 'close'
-                
-                # Remove port from hostname if necessary
-                host = headers.get_single('Host')
-                if ':' in host:
-                    parts = host.split(':',1)
-                    if router.secure and parts[1] == '443': host = parts[0]
-                    if not router.secure and parts[1] == '80': host = parts[0]
-                    headers.set('Host', host)
-                
-                # Add remote IP
-                headers.set('X-Forwarded-For', addr[0])
-                
-                # Remove reserved headers
-                headers.remove('X-Authenticated-User')
-                
-                # Indicate non-persistent connection
-                headers.set('Connection', 'close')
-                
-                # Validate session
-                session_cookies = headers.get_cookie('atom-session')
-                uid = router.sessions.validate_session(host, session_cookies, addr[0])
-                
-                if uid != False:
-                    headers.set('X-Authenticated-User', str(uid))
-                
-                if headers.path == '/+atom/login':
-                    client_sock = router.sessions.get_socket()
-                else:
-                    if uid == False:
-                        client_sock = router.sessions.get_socket()
-                    else:
-                        if headers.uri.startswith('/+atom'):
-                            response = HTTPHeaders.response(404)
-                            sock.send_headers(response)
-                            sock.close()
-                            return
-                        else:
-                            if router.directory.check_authorization(uid, host):
-                                client_sock = router.directory.get_socket(host, headers.uri)
-                                if not client_sock:
-                                    sock.send_headers(HTTPHeaders.response(404))
-                                    sock.close()
-                                    return
-                                
-                                headers.delete_cookie('atom-session')
-                            else:
-                                raise NotImplementedError()
-                
-                try:
-                    client_sock.send_headers(headers)
-                except HTTPError:
-                    log.exception()
-                    sock.error_close()
-                    return
-                
-                spawn(self._client_thread, sock, client_sock)
+            max_requests = router.max_keepalive_requests
+            for num_requests in xrange(1, max_requests+1):
+                headers = self._read_request(num_requests == 1)
+                if not headers:
+                    break
                 
-                for data in sock.read_body(raw = True):
-                    try:
-                        client_sock.send_body(data, raw = True)
-                    except HTTPError:
-                        log.exception()
-                        sock.error_close()
-                        return
+                keep_alive = num_requests < max_requests and \
+                    not headers.has_token('Connection', 'close')
                 
-                if connection_close:
+                if not self._handle(headers, keep_alive) or not keep_alive:
                     break
-        except HTTPError as e:
+        except (HTTPError, socket.error) as e:
             log.info('Client {} disconnected: {}', addr, e)
+        finally:
+            if self._last_response:
+                self._last_response.join()
+            self.sock.close()
+    
+    def _read_request(self, first):
+        # A pipelined request is read as soon as it is buffered. Otherwise
+        # the responses in flight are finished before the idle timer starts.
+        # Nothing more is read once a response has closed the connection.
+        if self._closed:
+            return None
+        if first or self.sock.buffered:
+            return self.sock.read_headers()
+        
+        self._last_response.join()
+        if self._closed:
+            return None
+        if not self.sock.wait_readable(self.router.timeouts.keepalive):
+            return None
+        return self.sock.read_headers()
     
-    def _client_thread(self, sock, client_sock):
+    def _handle(self, headers, keep_alive):
+        router, sock, addr = self.router, self.sock, self.addr
+        
+        # Remove port from hostname if necessary
+        host = headers.get_single('Host')
+        if ':' in host:
+            parts = host.split(':',1)
+            if router.secure and parts[1] == '443': host = parts[0]
+            if not router.secure and parts[1] == '80': host = parts[0]
+            headers.set('Host', host)
+        
+        # Add remote IP
+        headers.set('X-Forwarded-For', addr[0])
+        
+        # Remove reserved headers
+        headers.remove('X-Authenticated-User')
+        
+        # Remove hop-by-hop headers, except what is needed to pass on a
+        # protocol upgrade. The connection becomes a tunnel if it succeeds.
+        upgrade = headers.has_token('Connection', 'upgrade') and headers.get_single('Upgrade')
+        headers.remove('Keep-Alive')
+        headers.remove('Connection')
+        if upgrade:
+            headers.set('Connection', 'Upgrade')
+            keep_alive = False
+        else:
+            headers.remove('Upgrade')
+        
+        # Validate session
+        session_cookies = headers.get_cookie('atom-session')
+        uid = router.sessions.validate_session(host, session_cookies, addr[0])
+        
+        if uid != False:
+            headers.set('X-Authenticated-User', str(uid))
+        
+        if headers.path == '/+atom/login' or headers.path == '/+atom/logout':
+            return self._dispatch(router.sessions.handle, headers, keep_alive)
+        else:
+            if uid == False:
+                return self._dispatch(router.sessions.handle, headers, keep_alive)
+            else:
+                if headers.path == '/+atom/status' and addr[0] in router.status_addresses:
+                    return self._dispatch(router.handle_status, headers, keep_alive)
+                elif headers.uri.startswith('/+atom'):
+                    return self._respond(Response(404), headers, keep_alive)
+                else:
+                    if router.directory.check_authorization(uid, host):
+                        try:
+                            client_sock = router.directory.get_socket(host, headers.uri)
+                        except BackendBusyError as e:
+                            log.info('Turning away request for {}: {}', host, e)
+                            response = Response(503)
+                            response.headers.set('Retry-After', str(router.retry_after))
+                            return self._respond(response, headers, keep_alive)
+                        except (socket.error, ModuleError):
+                            log.exception('Unable to connect to backend for {}', host)
+                            return self._respond(Response(502), headers, False)
+                        if not client_sock:
+                            return self._respond(Response(404), headers, keep_alive)
+                        
+                        headers.delete_cookie('atom-session')
+                    else:
+                        raise NotImplementedError()
+        
         try:
-            response = client_sock.read_headers()
-        except HTTPError:
+            try:
+                client_sock.send_headers(headers)
+            except (HTTPError, socket.error):
+                if not self._can_retry(client_sock, headers):
+                    raise
+                client_sock = self._reconnect(client_sock, headers)
+        except (HTTPError, socket.error, BackendBusyError):
             log.exception()
-            sock.error_close()
-            client_sock.error_close()
-            return
+            client_sock.close()
+            return self._respond(Response(502), headers, False)
         
-        response.set('Server','atom/0.0')
+        exchange = Exchange(self, headers, client_sock, self._last_response, sock.expect_continue)
+        exchange.start(exchange.downstream, self._relay_response, exchange, keep_alive)
+        self._last_response = exchange.downstream.greenlet
         
+        if upgrade:
+            exchange.join()
+            return False
+        
+        if headers.get_chunked() or headers.get_content_length():
+            exchange.start(exchange.upstream, self._send_request_body, exchange)
+            exchange.upstream.join()
+        return not exchange.failed and not exchange.body_skipped
+    
+    def _send_request_body(self, exchange):
+        # A client expecting 100 Continue gets it when the backend sends one,
+        # or after EXPECT_CONTINUE_TIMEOUT in case the backend never will.
+        # If the backend answers first the body is never sent at all.
+        if exchange.expecting:
+            exchange.continued.wait(EXPECT_CONTINUE_TIMEOUT)
+            if exchange.body_skipped:
+                return 0
+            exchange.body_started = True
+            if exchange.previous:
+                exchange.previous.join()
+        return self.sock.relay_body(exchange.backend)
+    
+    def _can_retry(self, client_sock, request):
+        return isinstance(client_sock, BackendConnection) and client_sock.can_retry(request)
+    
+    def _reconnect(self, client_sock, request):
+        log.debug('Retrying {} {} on a new backend connection', request.method, request.uri)
+        client_sock.close()
+        client_sock = client_sock.pool.get(fresh = True)
+        client_sock.send_headers(request)
+        return client_sock
+    
+    def _read_response(self, client_sock, request):
         try:
-            sock.send_headers(response)
-        except HTTPError:
-            log.exception()
-            sock.error_close()
-            client_sock.error_close()
+            return client_sock, client_sock.read_headers()
+        except HTTPConnectionClosedError:
+            if not self._can_retry(client_sock, request):
+                raise
+        client_sock = self._reconnect(client_sock, request)
+        return client_sock, client_sock.read_headers()
+    
+    def _dispatch(self, handler, request, keep_alive):
+        # Built-in handlers run right here on the parsed request and read the
+        # body, if they want it, from the client connection. Reading it sends
+        # any 100 Continue, which has to come after the responses before.
+        if self.sock.expect_continue and self._last_response:
+            self._last_response.join()
+        
+        body = RequestBody(self.sock, request)
+        try:
+            response = handler(request, body)
+        except HTTPBodyTooLargeError as e:
+            log.info('Request body from {} refused: {}', self.addr, e)
+            return self._respond(Response(413), request, False)
+        except HTTPSyntaxError as e:
+            log.info('Bad request body from {}: {}', self.addr, e)
+            return self._respond(Response(400), request, False)
+        return self._respond(response, request, keep_alive, body.complete)
+    
+    def _respond(self, response, request, keep_alive, body_read = False):
+        # Answer locally. If the request body has not been read the
+        # connection cannot be reused.
+        if not body_read and (request.get_chunked() or request.get_content_length()):
+            keep_alive = False
+        self._last_response = spawn(self._send_response, self._last_response, response, keep_alive)
+        return keep_alive
+    
+    def _send_response(self, previous, response, keep_alive):
+        if previous:
+            previous.join()
+        if self._closed:
             return
         
+        headers = response.headers
+        if not keep_alive:
+            headers.set('Connection', 'close')
+        headers.set('Server','atom/0.0')
+        
         try:
-            for data in client_sock.read_body(raw = True):
-                try:
-                    sock.send_body(data, raw = True)
-                except HTTPError:
-                    return
-        except HTTPError:
+            self.sock.send_headers(headers, more = True)
+            self.sock.send_body(response.body)
+        except (HTTPError, socket.error):
+            keep_alive = False
+        
+        if not keep_alive:
+            self._close()
+    
+    def _relay_response(self, exchange, keep_alive):
+        sock, request = self.sock, exchange.request
+        client_sock, response = self._read_response(exchange.backend, request)
+        exchange.backend = client_sock
+        
+        # Responses go back in request order
+        if exchange.previous:
+            exchange.previous.join()
+        if self._closed:
+            client_sock.close()
+            return 0
+        
+        # Interim responses are passed on as they come, a 100 Continue only
+        # if the client is waiting for one. After the final response a
+        # request body still held back is never sent, and one started
+        # without the backend asking for it is cut off, so neither
+        # connection can carry anything else.
+        while response.code < 200 and response.code != 101:
+            if response.code == 100:
+                exchange.continue_body()
+            else:
+                sock.send_interim(response)
+            response = client_sock.read_headers()
+        if exchange.expecting:
+            exchange.skip_body()
+        if exchange.body_skipped:
+            keep_alive = False
+        
+        # Keep the client connection only if the body is delimited some
+        # other way than by the upstream closing
+        if client_sock.read_until_close:
+            keep_alive = False
+        
+        upgraded = response.code == 101 and request.has_token('Connection', 'upgrade')
+        response.remove('Keep-Alive')
+        if upgraded:
+            response.set('Connection', 'Upgrade')
+        elif keep_alive:
+            response.remove('Connection')
+        else:
+            response.set('Connection', 'close')
+        response.set('Server','atom/0.0')
+        
+        exchange.responding = True
+        sock.send_headers(response, more = True)
+        
+        if upgraded:
+            sock.flush()
+            exchange.start(exchange.upstream, sock.relay_all, client_sock)
+            relayed = client_sock.relay_all(sock)
+            exchange.upstream.join()
+            client_sock.close()
+            self._close()
+            return relayed
+        
+        relayed = client_sock.relay_body(sock)
+        
+        # The backend can be reused once the request has been sent in full;
+        # if sending it failed this greenlet has been killed by now
+        exchange.upstream.join()
+        if exchange.body_skipped:
+            client_sock.close()
+        else:
+            client_sock.release()
+        if not keep_alive:
+            self._close()
+        return relayed
+    
+    def _abort(self, exchange):
+        # One side of an exchange failed and the other has been cancelled.
+        # Earlier responses still go out, then the connection is closed,
+        # with an error response if this one hadn't started.
+        exchange.backend.close()
+        if exchange.previous:
+            exchange.previous.join()
+        if self._closed:
             return
+        if not exchange.responding:
+            try:
+                self.sock.error_close()
+            except (HTTPError, socket.error):
+                pass
+        self._close()
     
+    def _close(self):
+        self._closed = True
+        self.sock.close()
 
 
+class Exchange(DuplexPump):
+    # One request and its response: upstream carries the request body to the
+    # backend, downstream the response back to the client
+    
+    def __init__(self, conn, request, backend, previous, expecting = False):
+        DuplexPump.__init__(self, '{} {}'.format(request.method, request.uri))
+        self.conn = conn
+        self.request = request
+        self.backend = backend
+        self.previous = previous
+        self.responding = False
+        self.expecting = expecting
+        self.continued = Event()
+        self.body_started = False
+        self.body_skipped = False
+        self.body_requested = False
+    
+    def continue_body(self):
+        # The backend has asked for the request body
+        if not self.body_skipped:
+            self.conn.sock.send_continue()
+            self.body_requested = True
+            self.continued.set()
+    
+    def skip_body(self):
+        # The backend has answered without waiting for the request body. If
+        # the body was started after EXPECT_CONTINUE_TIMEOUT instead, the
+        # backend may never read the rest, so sending it is stopped rather
+        # than left to wait out the body timeout.
+        if not self.body_started:
+            self.body_skipped = True
+            self.continued.set()
+        elif not self.body_requested and self.upstream.greenlet and not self.upstream.greenlet.dead:
+            self.body_skipped = True
+            self.upstream.greenlet.kill(block = False)
+    
+    def on_error(self, direction, error):
+        self.conn._abort(self)
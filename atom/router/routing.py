@@ -0,0 +1,60 @@
+class RoutingTable(object):
+    # Maps "hostname[/path]" patterns to modules. Hostnames may start with
+    # "*." to match any subdomain. Host lookups are dict hits and paths are
+    # matched on whole segments, longest prefix first, so a lookup costs
+    # O(labels + path depth) however many routes there are.
+    
+    def __init__(self, routes = ()):
+        self._exact = {}
+        self._wildcard = {}
+        for pattern, module in routes:
+            self.add(pattern, module)
+    
+    def add(self, pattern, module):
+        host, _, path = pattern.partition('/')
+        host = host.lower()
+        if host.startswith('*.'):
+            hosts, host = self._wildcard, host[2:]
+        else:
+            hosts = self._exact
+        
+        node = hosts.setdefault(host, PathNode())
+        for segment in _segments(path):
+            node = node.children.setdefault(segment, PathNode())
+        node.module = module
+    
+    def lookup(self, hostname, path):
+        hostname = hostname.lower()
+        segments = _segments(path)
+        
+        node = self._exact.get(hostname)
+        module = node.lookup(segments) if node else None
+        
+        # The most specific wildcard wins
+        _, sep, parent = hostname.partition('.')
+        while not module and sep:
+            node = self._wildcard.get(parent)
+            module = node.lookup(segments) if node else None
+            _, sep, parent = parent.partition('.')
+        
+        return module
+
+
+class PathNode(object):
+    def __init__(self):
+        self.children = {}
+        self.module = None
+    
+    def lookup(self, segments):
+        node, module = self, self.module
+        for segment in segments:
+            node = node.children.get(segment)
+            if not node:
+                break
+            if node.module:
+                module = node.module
+        return module
+
+
+def _segments(path):
+    return [s for s in path.split('/') if s]
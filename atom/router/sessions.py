@@ -4,19 +4,44 @@ import time
 import hashlib
 import random
 
+from datetime import datetime
 from base64 import urlsafe_b64encode as b64encode
 from base64 import urlsafe_b64decode as b64decode
 
-from gevent import spawn
+from collections import OrderedDict
 
-from atom.http import HTTPHeaders, http_socket_pair
+from gevent import spawn, sleep
+
+from atom.http import FormLimits, HTTPSyntaxError, http_socket_pair, close_files
+from atom.router.handlers import Response, RequestBody
+from atom.router.tokens import SessionTokens
+from atom.router.passwords import LoginThrottled, LOGIN_RETRY_AFTER
 from atom.logger import get_logger
 
 log = get_logger(__name__)
 
+SESSION_TIMEOUT = 60*60*24
+SESSION_CACHE_SIZE = 10000
+LAST_SEEN_FLUSH_INTERVAL = 60
+LAST_SEEN_BATCH_SIZE = 500
+SESSION_SWEEP_INTERVAL = 60*5
+SESSION_SWEEP_BATCH_SIZE = 1000
+SESSION_CACHE_TTL = 10
+
+# The login form is small, so anything much bigger is refused
+LOGIN_FORM_LIMITS = FormLimits(max_size = 16384, max_memory = 16384,
+    max_field_size = 4096, max_fields = 16)
+
 class SessionManager(object):
-    def __init__(self, router):
+    def __init__(self, router, sweep_interval = SESSION_SWEEP_INTERVAL,
+                 sweep_batch_size = SESSION_SWEEP_BATCH_SIZE, cache_ttl = None, tokens = False):
         self.router = router
+        self.cache_ttl = cache_ttl
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        self.last_sweep = None
+        self._cache = SessionCache(SESSION_CACHE_SIZE)
+        self._last_seen = {}
         
         self.router.database.execute(
             'CREATE TABLE IF NOT EXISTS sessions (' +
@@ -27,11 +52,19 @@ class SessionManager(object):
             'remote_ip TEXT NOT NULL,' +
             'created   INTEGER NOT NULL,' +
             'last_seen INTEGER NOT NULL)')
-    
-    def validate_session(self, hostname, session_cookies, remote_ip):
-        if len(session_cookies) == 0:
-            return False
+        self.router.database.execute(
+            'CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)')
+        self.router.database.execute(
+            'CREATE INDEX IF NOT EXISTS sessions_key_hostname ON sessions (key, hostname)')
         
+        # With tokens, new sessions are signed cookies rather than database
+        # rows; sessions created before switching over still work
+        self.tokens = SessionTokens(self.router.database, SESSION_TIMEOUT) if tokens else None
+        
+        spawn(self._flush_periodically)
+        spawn(self._sweep_periodically)
+    
+    def _parse_cookies(self, session_cookies):
         uid_key_pairs = []
         for cookie in session_cookies:
             parts = cookie.split('-')
@@ -42,52 +75,204 @@ class SessionManager(object):
             except ValueError:
                 continue
             uid_key_pairs.append(pair)
+        return uid_key_pairs
+    
+    def validate_session(self, hostname, session_cookies, remote_ip):
+        if len(session_cookies) == 0:
+            return False
+        
+        if self.tokens:
+            for cookie in session_cookies:
+                if self.tokens.is_token(cookie):
+                    uid = self.tokens.validate(cookie, hostname, remote_ip)
+                    if uid != None:
+                        return uid
+        
+        uid_key_pairs = self._parse_cookies(session_cookies)
         
         now = int(time.time())
-        cutoff = now - 60*60*24;
-        db = self.router.database.cursor()
-        db.execute('DELETE FROM sessions WHERE last_seen < ?', (cutoff,))
+        cutoff = now - SESSION_TIMEOUT
+        
+        # Sessions seen recently are answered from memory
+        for uid, key in uid_key_pairs:
+            session = self._cache.get(key)
+            if session and (session.last_seen < cutoff or self._is_stale(session, now)):
+                self._cache.remove(key)
+            elif session:
+                if session.uid != uid or session.hostname != hostname or session.remote_ip != remote_ip:
+                    continue
+                self._touch(session, now)
+                return uid
         
+        # Expired sessions are left for the sweeper to delete
         for uid, key in uid_key_pairs:
-            db.execute('SELECT user_id, hostname, remote_ip FROM sessions WHERE key = ?', (key,))
-            row = db.fetchone()
-            if not row or row[0] != uid or row[1] != hostname or row[2] != remote_ip:
+            row = self.router.database.query_one(
+                'SELECT user_id, hostname, remote_ip FROM sessions ' +
+                'WHERE key = ? AND hostname = ? AND last_seen >= ?', (key, hostname, cutoff))
+            if not row or row[0] != uid or row[2] != remote_ip:
                 continue
-            db.execute('UPDATE sessions SET last_seen = ? WHERE key = ?', (now, key))
+            session = Session(key, *row)
+            session.checked = now
+            self._cache.add(session)
+            self._touch(session, now)
             return uid
         
         return False
     
+    def _is_stale(self, session, now):
+        # With cache_ttl set, cached sessions must be confirmed against the
+        # database every so often since other processes may delete them
+        return self.cache_ttl != None and now - session.checked >= self.cache_ttl
+    
+    def _touch(self, session, now):
+        # last_seen is only written back to the database in batches
+        session.last_seen = now
+        self._last_seen[session.key] = now
+        if len(self._last_seen) >= LAST_SEEN_BATCH_SIZE:
+            self.flush_last_seen()
+    
+    def flush_last_seen(self):
+        if len(self._last_seen) == 0:
+            return
+        updates = [(last_seen, key) for key, last_seen in self._last_seen.iteritems()]
+        self._last_seen = {}
+        self.router.database.executemany(
+            'UPDATE sessions SET last_seen = ? WHERE key = ?', updates, wait = False)
+    
+    def _flush_periodically(self):
+        while True:
+            sleep(LAST_SEEN_FLUSH_INTERVAL)
+            try:
+                self.flush_last_seen()
+            except Exception:
+                log.exception('Unable to save session activity')
+    
+    def sweep(self):
+        # Delete expired sessions a batch at a time so that no single
+        # transaction holds up other writes for long
+        start = time.time()
+        self.flush_last_seen()
+        if self.tokens:
+            self.tokens.sweep()
+        cutoff = int(start) - SESSION_TIMEOUT
+        
+        removed = 0
+        while True:
+            count = self.router.database.execute(
+                'DELETE FROM sessions WHERE id IN (' +
+                'SELECT id FROM sessions WHERE last_seen < ? LIMIT ?)', (cutoff, self.sweep_batch_size))
+            removed += count
+            if count < self.sweep_batch_size:
+                break
+        
+        duration = time.time() - start
+        self.last_sweep = (removed, duration)
+        log.info('Removed {} expired sessions in {:.3f}s', removed, duration)
+        return removed, duration
+    
+    def _sweep_periodically(self):
+        while True:
+            sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                log.exception('Unable to remove expired sessions')
+    
     def _generate_nonce(self):
         random_bytes = ''.join(chr(random.getrandbits(8)) for _ in xrange(64))
         return hashlib.sha512(random_bytes+str(time.time())).hexdigest()
     
     def create_session(self, uid, hostname, remote_ip):
+        if self.tokens:
+            return self.tokens.issue(uid, hostname, remote_ip)
+        
         key = self._generate_nonce()
         now = int(time.time())
         self.router.database.execute(
             'INSERT INTO sessions VALUES (NULL, ?, ?, ?, ?, ?, ?)',
             (uid, hostname, key, remote_ip, now, now))
         
+        session = Session(key, uid, hostname, remote_ip)
+        session.last_seen = session.checked = now
+        self._cache.add(session)
+        
         return str(uid) + '-' + key
     
-    def delete_sessions(self, keys):
-        pass
+    def delete_sessions(self, session_cookies):
+        if self.tokens:
+            for cookie in session_cookies:
+                if self.tokens.is_token(cookie):
+                    self.tokens.revoke(cookie)
+        
+        keys = [key for uid, key in self._parse_cookies(session_cookies)]
+        for key in keys:
+            self._cache.remove(key)
+            self._last_seen.pop(key, None)
+        self.router.database.executemany('DELETE FROM sessions WHERE key = ?', [(key,) for key in keys])
     
     def get_sessions(self):
         pass
     
+    def handle(self, request, body):
+        # Entry point for the router: the login pages and the redirect for
+        # anything requested without a session
+        return LoginHandler(self.router, request, body).response
+    
     def get_socket(self):
+        # For tests: the same handler behind an in-memory HTTP connection
         client, server = http_socket_pair()
         spawn(SessionManagerHTTPConnection, self.router, server)
         return client
 
 
+class Session(object):
+    def __init__(self, key, uid, hostname, remote_ip):
+        self.key = key
+        self.uid = uid
+        self.hostname = hostname
+        self.remote_ip = remote_ip
+        self.last_seen = None
+        self.checked = None
+
+
+class SessionCache(object):
+    # Least recently used sessions are evicted first
+    def __init__(self, size):
+        self.size = size
+        self._sessions = OrderedDict()
+    
+    def get(self, key):
+        session = self._sessions.pop(key, None)
+        if session:
+            self._sessions[key] = session
+        return session
+    
+    def add(self, session):
+        self._sessions.pop(session.key, None)
+        self._sessions[session.key] = session
+        if len(self._sessions) > self.size:
+            self._sessions.popitem(last = False)
+    
+    def remove(self, key):
+        self._sessions.pop(key, None)
+
+
 class SessionManagerHTTPConnection(object):
+    # Serves the login handler over an HTTPSocket. The router calls the
+    # handler directly; this is only for exercising it with an HTTP client.
     def __init__(self, router, sock):
+        request = sock.read_headers()
+        response = router.sessions.handle(request, RequestBody(sock, request))
+        sock.send_headers(response.headers, more = True)
+        sock.send_body(response.body)
+        sock.close()
+
+
+class LoginHandler(object):
+    def __init__(self, router, request, body):
         self.router = router
-        self.sock = sock
-        self.headers = sock.read_headers()
+        self.headers = request
+        self.body = body
         
         self.host = self.headers.get_single('Host')
         self.remote_ip = self.headers.get_single('X-Forwarded-For')
@@ -101,7 +286,13 @@ class SessionManagerHTTPConnection(object):
         
         log.debug('SessionManager received "{}" request for "{}{}"', self.headers.method, self.host, self.headers.uri)
         
-        if self.headers.path != '/+atom/login':
+        if self.headers.path == '/+atom/logout':
+            if self.headers.method in ('GET', 'POST'):
+                self.logout(existing_keys)
+            else:
+                self.response = Response(405)
+                self.response.headers.set('Allow', 'GET, HEAD, POST')
+        elif self.headers.path != '/+atom/login':
             # The router should only send us these requests if not logged in
             assert not uid
             ret = b64encode(self.host + self.headers.uri)
@@ -114,17 +305,23 @@ class SessionManagerHTTPConnection(object):
                     else:
                         self.show_login('')
                 elif self.headers.method == 'POST':
-                    uid = self.check_login()
-                    if not uid:
-                        self.show_login('Invalid username or password')
+                    # A throttled client is turned away before its form is
+                    # read or it is told to continue sending it
+                    try:
+                        self.router.passwords.check(self.remote_ip)
+                        uid = self.check_login()
+                    except LoginThrottled as e:
+                        self.response = Response(e.code, 'Too many logins, try again shortly\n', 'text/plain')
+                        self.response.headers.set('Retry-After', str(LOGIN_RETRY_AFTER))
                     else:
-                        key = self.router.sessions.create_session(uid, self.host, self.remote_ip)
-                        self.return_redirect(uid, key)
+                        if not uid:
+                            self.show_login('Invalid username or password')
+                        else:
+                            key = self.router.sessions.create_session(uid, self.host, self.remote_ip)
+                            self.return_redirect(uid, key)
                 else:
-                    response = HTTPHeaders.response(405)
-                    response.set('Allow', 'GET, HEAD, POST')
-                    sock.send_headers(response)
-                    sock.close()
+                    self.response = Response(405)
+                    self.response.headers.set('Allow', 'GET, HEAD, POST')
             else:
                 if self.headers.method == 'GET':
                     if 'key' in self.headers.args:
@@ -142,10 +339,8 @@ class SessionManagerHTTPConnection(object):
                     else:
                         self.redirect(system_host + '/+atom/login')
                 else:
-                    response = HTTPHeaders.response(405)
-                    response.set('Allow', 'GET, HEAD')
-                    sock.send_headers(response)
-                    sock.close()
+                    self.response = Response(405)
+                    self.response.headers.set('Allow', 'GET, HEAD')
     
     def return_redirect(self, uid, key = None):
         if 'return' in self.headers.args:
@@ -162,12 +357,17 @@ class SessionManagerHTTPConnection(object):
     
     def redirect(self, host_and_path, key = None):
         scheme = 'https://' if self.router.secure else 'http://'
-        response = HTTPHeaders.response(302)
-        response.set('Location', scheme + host_and_path)
+        self.response = Response(302)
+        self.response.headers.set('Location', scheme + host_and_path)
         if key:
-            response.set_cookie('atom-session', key, expires=False, secure=self.router.secure, httponly=True)
-        self.sock.send_headers(response)
-        self.sock.close()
+            self.response.headers.set_cookie('atom-session', key, expires=False, secure=self.router.secure, httponly=True)
+    
+    def logout(self, existing_keys):
+        # Only the sessions for this host are ended; others stay logged in
+        self.router.sessions.delete_sessions(existing_keys)
+        self.redirect(self.router.directory.get_system_hostname() + '/+atom/login')
+        self.response.headers.set_cookie('atom-session', '', expires=datetime.utcfromtimestamp(0),
+            secure=self.router.secure, httponly=True)
     
     def show_login(self, message):
         args = self.headers.args
@@ -176,22 +376,23 @@ class SessionManagerHTTPConnection(object):
         else:
             post_url = '/+atom/login'
         
-        response = HTTPHeaders.response(200)
-        response.set('Content-Type', 'text/html')
-        self.sock.send_headers(response)
-        
         with open('login.html') as f:
-            self.sock.send_body(Template(f.read()).substitute({
+            body = Template(f.read()).substitute({
                 'message': message,
                 'post_url': post_url
-            }))
-            self.sock.close()
+            })
+        
+        self.response = Response(200, body, 'text/html')
     
     def check_login(self):
-        args = self.sock.read_form_body()
+        # Uploaded files have no place in a login, and are refused with a 400
+        args = self.body.read_form(LOGIN_FORM_LIMITS)
+        close_files(args)
         if 'username' not in args or 'password' not in args:
             return None
         
         username = args['username'][0]
         password = args['password'][0]
-        return self.router.directory.check_login(username, password)
+        if not isinstance(username, str) or not isinstance(password, str):
+            raise HTTPSyntaxError('Login form fields must not be files')
+        return self.router.directory.check_login(username, password, self.remote_ip)
@@ -0,0 +1,297 @@
+import os
+import time
+import fcntl
+import ctypes
+import ctypes.util
+import signal
+
+from gevent import spawn, sleep, socket, subprocess, Timeout
+from gevent.event import AsyncResult
+
+from atom.router.balancer import STRATEGIES
+from atom.router.manifest import ModuleManifest, ModuleManifestError
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+MODULE_IDLE_TIMEOUT = 60*10
+MODULE_START_TIMEOUT = 10
+MODULE_STOP_TIMEOUT = 5
+START_POLL_INTERVAL = 0.05
+ACTIVITY_INTERVAL = 10
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 2
+HEALTH_CHECK_FAILURES = 3
+RESTART_DELAY_MIN = 1
+RESTART_DELAY_MAX = 60
+PR_SET_PDEATHSIG = 1
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+except OSError:
+    _libc = None
+
+
+class ModuleError(Exception):
+    pass
+
+
+class ModuleSupervisor(object):
+    # Starts a module's worker processes when it is first used and stops
+    # them once it has gone unused for idle_timeout. With several router
+    # processes, whichever takes the module's lock file runs the workers and
+    # the rest just connect to them. All of them touch the lock file as they
+    # use the module, so idleness is judged across processes.
+    
+    def __init__(self, router, idle_timeout = MODULE_IDLE_TIMEOUT):
+        self.router = router
+        self.idle_timeout = idle_timeout
+        self._modules = {}
+        if not os.path.isdir(router.run_dir):
+            os.makedirs(router.run_dir)
+        spawn(self._check_periodically)
+    
+    def get_addresses(self, name):
+        # Socket paths for the module's workers, once at least one is
+        # accepting connections
+        return self._get(name).get_addresses()
+    
+    def choose(self, name):
+        # The worker socket to send the next request to, as the module's
+        # balancing strategy sees it
+        module = self._get(name)
+        addresses = module.get_addresses()
+        return self.router.backends.choose(addresses, module.balancer)
+    
+    def _get(self, name):
+        module = self._modules.get(name)
+        if not module:
+            module = self._modules[name] = ModuleProcesses(self, name)
+        return module
+    
+    def connect_failed(self, address):
+        # Whoever runs the module may have stopped it, so check again before
+        # the next use
+        for module in self._modules.values():
+            if module.addresses and address in module.addresses:
+                module.running = False
+    
+    def _check_periodically(self):
+        while True:
+            sleep(HEALTH_CHECK_INTERVAL)
+            for module in self._modules.values():
+                try:
+                    module.check()
+                except Exception:
+                    log.exception('Unable to check module {}', module.name)
+
+
+class ModuleProcesses(object):
+    def __init__(self, supervisor, name):
+        router = supervisor.router
+        self.supervisor = supervisor
+        self.name = name
+        self.path = os.path.join(router.apps_dir, name)
+        self.run_dir = router.run_dir
+        self.lock_path = os.path.join(router.run_dir, name + '.lock')
+        self.command = None
+        self.balance = None
+        self.balancer = None
+        self.addresses = None
+        self.workers = []
+        self.running = False
+        self.owner = False
+        self._lock_fd = None
+        self._starting = None
+        self._touched = 0
+    
+    def get_addresses(self):
+        self._touch()
+        if not self.running:
+            if self._starting:
+                self._starting.get()
+            else:
+                self._starting = AsyncResult()
+                try:
+                    self._start()
+                except Exception as e:
+                    self._starting.set_exception(e)
+                    raise
+                else:
+                    self._starting.set()
+                finally:
+                    self._starting = None
+        return self.addresses
+    
+    def _touch(self):
+        now = time.time()
+        if now - self._touched >= ACTIVITY_INTERVAL:
+            self._touched = now
+            try:
+                os.utime(self.lock_path, None)
+            except OSError:
+                pass
+    
+    def _load_manifest(self):
+        try:
+            manifest = ModuleManifest(self.path)
+        except ModuleManifestError as e:
+            raise ModuleError('module {}: {}'.format(self.name, e))
+        self.command = manifest.command
+        if not self.balancer or manifest.balance != self.balance:
+            self.balance = manifest.balance
+            self.balancer = STRATEGIES[manifest.balance]()
+        self.addresses = [os.path.join(self.run_dir, '{}.{}.sock'.format(self.name, i))
+                          for i in xrange(manifest.workers)]
+    
+    def _start(self):
+        if not self.owner:
+            self._load_manifest()
+        
+        # Another router process may be running or starting the module, or
+        # may go away while it does, in which case this one takes over
+        deadline = time.time() + MODULE_START_TIMEOUT
+        started = False
+        while True:
+            if not self.owner and self._try_lock():
+                self._start_workers()
+                started = True
+            if any(_connectable(address) for address in self.addresses):
+                break
+            if time.time() > deadline:
+                if started:
+                    self.stop()
+                raise ModuleError('module {} did not start listening'.format(self.name))
+            sleep(START_POLL_INTERVAL)
+        
+        self.running = True
+        self._touched = 0
+        self._touch()
+    
+    def _try_lock(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        self.owner = True
+        return True
+    
+    def _start_workers(self):
+        log.info('Starting module {} with {} workers', self.name, len(self.addresses))
+        self.workers = [ModuleWorker(self, i, address) for i, address in enumerate(self.addresses)]
+        for worker in self.workers:
+            worker.start()
+    
+    def check(self):
+        if not self.owner:
+            return
+        if time.time() - os.stat(self.lock_path).st_mtime > self.supervisor.idle_timeout:
+            log.info('Stopping idle module {}', self.name)
+            self.stop()
+            return
+        for worker in self.workers:
+            worker.check_health()
+    
+    def stop(self):
+        self.running = False
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+        os.close(self._lock_fd)
+        self._lock_fd = None
+        self.owner = False
+
+
+class ModuleWorker(object):
+    # One module process listening on its own socket, restarted with an
+    # increasing delay if it keeps exiting
+    
+    def __init__(self, module, index, address):
+        self.module = module
+        self.index = index
+        self.address = address
+        self.process = None
+        self.stopping = False
+        self.failures = 0
+        self._greenlet = None
+    
+    def start(self):
+        self._greenlet = spawn(self._run)
+    
+    def _run(self):
+        delay = RESTART_DELAY_MIN
+        while not self.stopping:
+            started = time.time()
+            try:
+                self._spawn_process()
+                status = self.process.wait()
+            except OSError as e:
+                status = e
+            if self.stopping:
+                break
+            
+            if time.time() - started > RESTART_DELAY_MAX:
+                delay = RESTART_DELAY_MIN
+            log.error('Module {} worker {} exited ({}), restarting in {}s',
+                self.module.name, self.index, status, delay)
+            sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+    
+    def _spawn_process(self):
+        self._remove_socket()
+        env = dict(os.environ, ATOM_MODULE = self.module.name,
+                   ATOM_SOCKET = self.address, ATOM_WORKER = str(self.index))
+        args = [arg.replace('{socket}', self.address) for arg in self.module.command]
+        self.failures = 0
+        self.process = subprocess.Popen(args, cwd = self.module.path, env = env,
+            close_fds = True, preexec_fn = die_with_parent)
+    
+    def check_health(self):
+        if not self.process or self.process.poll() != None:
+            return
+        if _connectable(self.address):
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= HEALTH_CHECK_FAILURES:
+            log.error('Module {} worker {} is not accepting connections, restarting',
+                self.module.name, self.index)
+            self.process.kill()
+    
+    def stop(self):
+        self.stopping = True
+        if self.process and self.process.poll() == None:
+            self.process.terminate()
+            with Timeout(MODULE_STOP_TIMEOUT, False):
+                self.process.wait()
+            if self.process.poll() == None:
+                self.process.kill()
+        self._greenlet.kill()
+        self._remove_socket()
+    
+    def _remove_socket(self):
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+
+
+def _connectable(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(HEALTH_CHECK_TIMEOUT)
+    try:
+        sock.connect(address)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+def die_with_parent():
+    # Runs in the child before exec, so module processes never outlive the
+    # router process supervising them
+    if _libc:
+        _libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
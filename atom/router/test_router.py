@@ -0,0 +1,179 @@
+import unittest
+
+from gevent import spawn, sleep
+
+from atom.http import HTTPSocket, HTTPHeaders, HTTPConnectionClosedError, FormLimits, Timeouts, memory_socket_pair
+from atom.router.handlers import Response
+from atom.router.router import RouterConnection, MAX_KEEPALIVE_REQUESTS
+
+TEST_TIMEOUT = 5
+FORM_LIMITS = FormLimits(max_size = 1000, max_memory = 200, max_field_size = 50, max_fields = 5)
+
+
+class TestRouter(object):
+    # Just enough of Router for a RouterConnection: every request is logged
+    # in, /+atom/login goes to handler and anything else to a new in-memory
+    # connection served by backend
+    secure = False
+    status_addresses = ()
+    max_keepalive_requests = MAX_KEEPALIVE_REQUESTS
+    
+    def __init__(self, handler = None, backend = None):
+        self.timeouts = Timeouts(header = TEST_TIMEOUT, body_idle = TEST_TIMEOUT,
+            request = TEST_TIMEOUT, keepalive = TEST_TIMEOUT)
+        self.sessions = self.directory = self
+        self.handler = handler
+        self.backend = backend
+    
+    def validate_session(self, hostname, session_cookies, remote_ip):
+        return 1
+    
+    def handle(self, request, body):
+        return self.handler(request, body)
+    
+    def check_authorization(self, uid, hostname):
+        return True
+    
+    def get_socket(self, hostname, uri):
+        client, server = memory_socket_pair()
+        spawn(self.backend, HTTPSocket(server, 'server'))
+        return HTTPSocket(client, 'client')
+
+
+def connect(router):
+    client, server = memory_socket_pair()
+    spawn(RouterConnection, router, server, ('127.0.0.1', 0))
+    return HTTPSocket(client, 'client')
+
+def request(method, uri, headers = (), body = None):
+    request = HTTPHeaders.request(method, uri)
+    request.set('Host', 'test')
+    for name, value in headers:
+        request.set(name, value)
+    if body != None:
+        request.set('Content-Length', str(len(body)))
+    return request
+
+def send(sock, request, body = None):
+    sock.send_headers(request, more = body != None)
+    if body != None:
+        sock.send_body(body, raw = True)
+
+def read_response(sock):
+    response = sock.read_headers()
+    body = ''.join(piece.tobytes() if isinstance(piece, memoryview) else piece for piece in sock.read_body())
+    return response, body
+
+def read_form(request, body):
+    fields = body.read_form(FORM_LIMITS)
+    return Response(200, repr(sorted(fields.items())), 'text/plain')
+
+
+class FormStatusTest(unittest.TestCase):
+    # Form bodies over a limit get a 413 and broken ones a 400, and either
+    # way the connection is closed since the rest of the body is unread
+    
+    def post(self, body, content_type = 'application/x-www-form-urlencoded', chunked = False):
+        sock = connect(TestRouter(read_form))
+        headers = [('Content-Type', content_type)]
+        if chunked:
+            req = request('POST', '/+atom/login', headers + [('Transfer-Encoding', 'chunked')])
+            sock.send_headers(req, more = True)
+            sock.send_body([body[i:i+10] for i in xrange(0, len(body), 10)])
+        else:
+            send(sock, request('POST', '/+atom/login', headers, body), body)
+        response, _ = read_response(sock)
+        return response.code, response.get_single('Connection')
+    
+    def test_within_limits(self):
+        self.assertEqual(self.post('a=1&b=2'), (200, None))
+    
+    def test_content_length_too_large(self):
+        self.assertEqual(self.post('a=' + 'x' * 2000), (413, 'close'))
+    
+    def test_limits(self):
+        for body in ['a=' + 'x' * 2000, 'a=' + 'x' * 60, '&'.join(['a=1'] * 6),
+                     '&'.join('a{}={}'.format(i, 'x' * 45) for i in xrange(5))]:
+            self.assertEqual(self.post(body, chunked = True), (413, 'close'), body)
+    
+    def test_invalid(self):
+        self.assertEqual(self.post('--x\r\n', 'multipart/form-data; boundary=x'), (400, 'close'))
+        self.assertEqual(self.post('a=1', 'text/plain'), (400, 'close'))
+
+
+def echo_path(sock):
+    # Answers with the request's path, /slow ones after a while, and closes
+    # the connection after a close-delimited response to /close
+    request = sock.read_headers()
+    for _ in sock.read_body():
+        pass
+    if request.path.startswith('/slow'):
+        sleep(0.1)
+    response = HTTPHeaders.response(200)
+    if request.path != '/close':
+        response.set('Content-Length', str(len(request.path)))
+    sock.send_headers(response, more = True)
+    sock.send_body(request.path)
+    sock.close()
+
+def local_path(request, body):
+    return Response(200, request.path, 'text/plain')
+
+
+class PipeliningTest(unittest.TestCase):
+    # Requests sent together are answered in order, and nothing after a
+    # request or response that closes the connection is answered
+    
+    def setUp(self):
+        self.router = TestRouter(local_path, echo_path)
+        self.sock = connect(self.router)
+    
+    def send_all(self, *requests):
+        for req in requests:
+            send(self.sock, req)
+    
+    def read_responses(self):
+        responses = []
+        while True:
+            try:
+                response, body = read_response(self.sock)
+            except HTTPConnectionClosedError:
+                return responses
+            responses.append((body, response.get_single('Connection')))
+    
+    def test_in_order(self):
+        self.send_all(request('GET', '/slow'), request('GET', '/a'), request('GET', '/slow2'),
+            request('GET', '/b', [('Connection', 'close')]))
+        self.assertEqual(self.read_responses(),
+            [('/slow', None), ('/a', None), ('/slow2', None), ('/b', 'close')])
+    
+    def test_local_responses_in_order(self):
+        self.send_all(request('GET', '/slow'), request('GET', '/+atom/login'),
+            request('GET', '/slow2', [('Connection', 'close')]))
+        self.assertEqual(self.read_responses(),
+            [('/slow', None), ('/+atom/login', None), ('/slow2', 'close')])
+    
+    def test_client_close(self):
+        self.send_all(request('GET', '/slow'), request('GET', '/a', [('Connection', 'close')]),
+            request('GET', '/b'))
+        self.assertEqual(self.read_responses(), [('/slow', None), ('/a', 'close')])
+    
+    def test_close_delimited_response(self):
+        # The connection has to close to end the body, so the requests
+        # already buffered behind it are dropped
+        self.send_all(request('GET', '/close'), request('GET', '/a'), request('GET', '/b'))
+        self.assertEqual(self.read_responses(), [('/close', 'close')])
+    
+    def test_max_keepalive_requests(self):
+        self.router.max_keepalive_requests = 2
+        self.send_all(request('GET', '/slow'), request('GET', '/a'), request('GET', '/b'))
+        self.assertEqual(self.read_responses(), [('/slow', None), ('/a', 'close')])
+    
+    def test_request_bodies(self):
+        send(self.sock, request('POST', '/slow', body = 'x' * 10), 'x' * 10)
+        send(self.sock, request('POST', '/a', body = 'y' * 5), 'y' * 5)
+        send(self.sock, request('GET', '/b', [('Connection', 'close')]))
+        self.assertEqual(self.read_responses(), [('/slow', None), ('/a', None), ('/b', 'close')])
+
+if __name__ == '__main__':
+    unittest.main()
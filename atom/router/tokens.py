@@ -0,0 +1,163 @@
+import os
+import hmac
+import time
+import hashlib
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from gevent import spawn, sleep
+
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+TOKEN_PREFIX = 't.'
+KEY_ROTATION_INTERVAL = 60*60*24
+TOKEN_REFRESH_INTERVAL = 10
+KEY_RELOAD_INTERVAL = 1
+
+
+class SessionTokens(object):
+    # Session cookies carrying the uid, hostname, remote address and expiry
+    # themselves, signed with HMAC-SHA256 under a server key, so checking
+    # one is CPU work only. Keys live in the database and are rotated daily;
+    # a key is kept until every token it signed has expired. Tokens revoked
+    # at logout are listed by id until they would have expired anyway, and
+    # each process picks up the others' revocations every few seconds.
+    # Unlike database sessions, tokens expire a fixed time after login.
+    
+    def __init__(self, database, lifetime):
+        self.database = database
+        self.lifetime = lifetime
+        self._keys = {}
+        self._current = None
+        self._revoked = {}
+        self._last_key_id = 0
+        self._last_revocation_id = 0
+        self._keys_loaded = 0
+        
+        database.execute(
+            'CREATE TABLE IF NOT EXISTS session_keys (' +
+            'id      INTEGER PRIMARY KEY,' +
+            'secret  TEXT NOT NULL,' +
+            'created INTEGER NOT NULL)')
+        database.execute(
+            'CREATE TABLE IF NOT EXISTS revoked_tokens (' +
+            'id       INTEGER PRIMARY KEY,' +
+            'token_id TEXT NOT NULL,' +
+            'expires  INTEGER NOT NULL)')
+        database.execute(
+            'CREATE INDEX IF NOT EXISTS revoked_tokens_expires ON revoked_tokens (expires)')
+        
+        self.refresh()
+        spawn(self._refresh_periodically)
+    
+    def is_token(self, cookie):
+        return cookie.startswith(TOKEN_PREFIX)
+    
+    def issue(self, uid, hostname, remote_ip):
+        key_id, secret, _ = self._current
+        expires = int(time.time()) + self.lifetime
+        payload = '|'.join([str(uid), hostname, remote_ip, str(expires), os.urandom(8).encode('hex')])
+        body = '{}.{}'.format(key_id, _encode(payload))
+        return TOKEN_PREFIX + body + '.' + _encode(_sign(secret, body))
+    
+    def validate(self, token, hostname, remote_ip):
+        # Returns the uid the token was issued to if it is still good for
+        # this hostname and address, otherwise None
+        fields = self._verify(token)
+        if not fields:
+            return None
+        uid, token_hostname, token_ip, expires, token_id = fields
+        if token_hostname != hostname or token_ip != remote_ip:
+            return None
+        if expires < time.time() or token_id in self._revoked:
+            return None
+        return uid
+    
+    def _verify(self, token):
+        try:
+            _, key_id, payload, signature = token.split('.')
+            key_id = int(key_id)
+        except ValueError:
+            return None
+        
+        # A key we don't know may have just been added by another process
+        if key_id not in self._keys and time.time() - self._keys_loaded >= KEY_RELOAD_INTERVAL:
+            self._load_keys()
+        if key_id not in self._keys:
+            return None
+        secret = self._keys[key_id][0]
+        
+        body = token[len(TOKEN_PREFIX):token.rindex('.')]
+        if not hmac.compare_digest(_encode(_sign(secret, body)), signature):
+            return None
+        try:
+            uid, hostname, remote_ip, expires, token_id = _decode(payload).split('|')
+            return int(uid), hostname, remote_ip, int(expires), token_id
+        except (ValueError, TypeError):
+            return None
+    
+    def revoke(self, token):
+        fields = self._verify(token)
+        if not fields:
+            return
+        expires, token_id = fields[3], fields[4]
+        self._revoked[token_id] = expires
+        self.database.execute('INSERT INTO revoked_tokens VALUES (NULL, ?, ?)',
+            (token_id, expires), wait = False)
+    
+    def refresh(self):
+        now = int(time.time())
+        self._load_keys()
+        if not self._current or now - self._current[2] >= KEY_ROTATION_INTERVAL:
+            log.info('Rotating session token key')
+            self.database.execute('INSERT INTO session_keys VALUES (NULL, ?, ?)',
+                (os.urandom(32).encode('hex'), now))
+            self._load_keys()
+        
+        rows = self.database.query(
+            'SELECT id, token_id, expires FROM revoked_tokens WHERE id > ?', (self._last_revocation_id,))
+        for revocation_id, token_id, expires in rows:
+            self._revoked[token_id] = expires
+            self._last_revocation_id = revocation_id
+        for token_id, expires in self._revoked.items():
+            if expires < now:
+                del self._revoked[token_id]
+    
+    def _load_keys(self):
+        self._keys_loaded = time.time()
+        rows = self.database.query(
+            'SELECT id, secret, created FROM session_keys WHERE id > ? ORDER BY id', (self._last_key_id,))
+        for key_id, secret, created in rows:
+            self._keys[key_id] = (secret, created)
+            self._current = (key_id, secret, created)
+            self._last_key_id = key_id
+    
+    def _refresh_periodically(self):
+        while True:
+            sleep(TOKEN_REFRESH_INTERVAL)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('Unable to refresh session token keys')
+    
+    def sweep(self):
+        # Each process forgets the keys it has loaded once they are deleted
+        now = int(time.time())
+        cutoff = now - KEY_ROTATION_INTERVAL - self.lifetime
+        self.database.execute('DELETE FROM revoked_tokens WHERE expires < ?', (now,))
+        self.database.execute('DELETE FROM session_keys WHERE created < ?', (cutoff,))
+        for key_id, (_, created) in self._keys.items():
+            if created < cutoff and key_id != self._current[0]:
+                del self._keys[key_id]
+
+
+def _sign(secret, body):
+    return hmac.new(secret, body, hashlib.sha256).digest()
+
+def _encode(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+def _decode(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
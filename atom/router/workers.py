@@ -0,0 +1,72 @@
+import os
+import time
+import errno
+import signal
+
+import gevent
+
+from atom.logger import get_logger
+
+log = get_logger(__name__)
+
+RESTART_DELAY = 1
+
+
+class WorkerSupervisor(object):
+    # Runs in the parent process, which serves nothing itself: it forks the
+    # workers, restarts any that exit and passes SIGTERM/SIGINT on to them.
+    # A worker that dies right after starting is restarted after a delay so
+    # that a broken configuration doesn't turn into a fork loop.
+    
+    def __init__(self, router, num_workers):
+        self.router = router
+        self.num_workers = num_workers
+        self._workers = {}
+        self._stopping = False
+    
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        
+        for _ in xrange(self.num_workers):
+            self._spawn()
+        
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            
+            started = self._workers.pop(pid, None)
+            if started == None or self._stopping:
+                continue
+            
+            log.error('Worker {} exited with status {}, restarting', pid, status)
+            if time.time() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            self._spawn()
+    
+    def _spawn(self):
+        pid = gevent.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                self.router.serve()
+            except BaseException:
+                log.exception('Worker {} failed', os.getpid())
+                os._exit(1)
+            os._exit(0)
+        
+        log.info('Started worker {}', pid)
+        self._workers[pid] = time.time()
+    
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+
+# Counts the sends needed to relay a chunked response, sending every piece
+# as it is read versus gathering them in HTTPSocket.send_body.
+#
+#   python bench/chunked.py [num_chunks] [chunk_size]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from atom.http import HTTPSocket, HTTPHeaders
+
+from recv_buffer import ScriptedSocket
+
+
+class CountingSocket(object):
+    def __init__(self):
+        self.sends = 0
+        self.sent = 0
+    
+    def sendall(self, data):
+        self.sends += 1
+        self.sent += len(data)
+
+
+def make_response(num_chunks, chunk_size):
+    chunks = ''.join('{:x}\r\n{}\r\n'.format(chunk_size, 'x' * chunk_size) for _ in xrange(num_chunks))
+    return 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + chunks + '0\r\n\r\n'
+
+
+def relay(response, legacy):
+    src = HTTPSocket(ScriptedSocket(response), 'client')
+    src._sent_method = 'GET'
+    dest = HTTPSocket(CountingSocket(), 'server')
+    headers = src.read_headers()
+    if legacy:
+        dest._sock.sendall(headers.raw)
+        for data in src.read_body(raw = True):
+            dest._sock.sendall(data)
+    else:
+        dest.send_headers(headers, more = True)
+        src.relay_body(dest)
+    return dest._sock
+
+
+def main():
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    response = make_response(num_chunks, chunk_size)
+    
+    legacy = relay(response, True)
+    current = relay(response, False)
+    
+    print 'response size: {:>8} bytes in {} chunks'.format(len(response), num_chunks)
+    print 'piece by piece: {:>7} sends, {} bytes'.format(legacy.sends, legacy.sent)
+    print 'coalesced:      {:>7} sends, {} bytes'.format(current.sends, current.sent)
+
+if __name__ == '__main__':
+    main()
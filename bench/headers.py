@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Measures request headers parsed per second by HTTPSocket.read_headers,
+# against the previous line-at-a-time reader and parser.
+#
+#   python bench/headers.py [iterations]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gevent import Timeout
+
+from atom.http import HTTPSocket, HTTPHeaders, HTTPSyntaxError, HTTPTimeoutError
+from atom.http.socket import RECV_TIMEOUT
+
+from recv_buffer import ScriptedSocket
+
+REQUEST = '\r\n'.join([
+    'GET /app/index.html?tab=recent&page=2 HTTP/1.1',
+    'Host: home.example.com',
+    'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0 Safari/537.36',
+    'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Encoding: gzip, deflate, sdch',
+    'Accept-Language: en-US,en;q=0.8',
+    'Cache-Control: max-age=0',
+    'Connection: keep-alive',
+    'Referer: http://home.example.com/app/',
+    'Cookie: atom-session=1-{}; _ga=GA1.2.1234567890.1234567890; prefs=compact'.format('f' * 128),
+    'If-Modified-Since: Sat, 01 Nov 2014 10:00:00 GMT',
+    'If-None-Match: "5454b9f0-1f4"',
+    'DNT: 1',
+]) + '\r\n\r\n'
+
+
+def legacy_read_headers(sock):
+    # Previous HTTPSocket.read_headers: one buffer split per line, then a
+    # second split of every header inside HTTPHeaders.parse
+    buf = ''
+    lines = []
+    while True:
+        while b'\r\n' not in buf:
+            with Timeout(RECV_TIMEOUT, HTTPTimeoutError()):
+                buf += sock.recv(4096)
+        line, buf = buf.split(b'\r\n',1)
+        if line == '':
+            break
+        lines.append(line)
+    
+    self = HTTPHeaders('request')
+    self.method, self.uri, self.http_version = lines[0].split(None, 2)
+    cur_header = None
+    for line in lines[1:]:
+        if line[0] in ' \t':
+            cur_header += '\r\n' + line
+        else:
+            if cur_header != None:
+                parts = cur_header.split(':',1)
+                if len(parts) != 2:
+                    raise HTTPSyntaxError()
+                self.add(parts[0], parts[1])
+            cur_header = line
+    if cur_header != None:
+        parts = cur_header.split(':',1)
+        self.add(parts[0], parts[1])
+    self.check_syntax()
+    
+    self.get_chunked()
+    self.get_content_length()
+    self.get_single('Content-Type')
+    return self
+
+
+def current_read_headers(sock):
+    return HTTPSocket(sock, 'server').read_headers()
+
+
+def measure(read_headers, iterations):
+    start = time.time()
+    for _ in xrange(iterations):
+        read_headers(ScriptedSocket(REQUEST))
+    return iterations / (time.time() - start)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    
+    legacy = measure(legacy_read_headers, iterations)
+    current = measure(current_read_headers, iterations)
+    
+    print 'line-at-a-time: {:>10.0f} requests/s'.format(legacy)
+    print 'single pass:    {:>10.0f} requests/s'.format(current)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Measures request latency on an in-memory HTTP connection while a storm of
+# logins is being checked, with passwords verified inline on the hub and in
+# a PasswordPool.
+#
+#   python bench/login_storm.py [logins] [concurrency] [requests]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gevent import spawn, sleep
+from gevent.pool import Pool
+
+from atom.http import HTTPHeaders, http_socket_pair
+from atom.router.passwords import PasswordPool, hash_password, verify_password
+
+REQUEST_INTERVAL = 0.005
+
+
+def serve(sock):
+    while True:
+        sock.read_headers()
+        response = HTTPHeaders.response(200)
+        response.set('Content-Length', '2')
+        sock.send_headers(response, more = True)
+        sock.send_body('ok', raw = True)
+
+def measure(verify, logins, concurrency, requests):
+    client, server = http_socket_pair()
+    spawn(serve, server)
+    stored = hash_password('secret')
+    
+    storm = Pool(concurrency)
+    for i in xrange(logins):
+        storm.spawn(verify, 'wrong' if i % 2 else 'secret', stored, '10.0.{}.{}'.format(i // 256 % 256, i % 256))
+    
+    # Requests go out on a fixed schedule and latency counts from when each
+    # was due, so time spent waiting for a blocked hub is included
+    latencies = []
+    begin = time.time()
+    for i in xrange(requests):
+        due = begin + i * REQUEST_INTERVAL
+        sleep(max(0, due - time.time()))
+        client.send_headers(HTTPHeaders.request('GET', '/'))
+        client.read_headers()
+        list(client.read_body())
+        latencies.append(time.time() - due)
+    storm.join()
+    
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return pick(0.5), pick(0.99), latencies[-1] * 1000
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    
+    pool = PasswordPool(max_pending = None, max_per_ip = None)
+    inline = measure(lambda password, stored, ip: verify_password(password, stored),
+        logins, concurrency, requests)
+    pooled = measure(pool.verify, logins, concurrency, requests)
+    pool.close()
+    
+    print '{} logins, {} at a time, {} requests'.format(logins, concurrency, requests)
+    print '                 p50 ms   p99 ms   max ms'
+    print 'inline:        {:>8.2f} {:>8.2f} {:>8.2f}'.format(*inline)
+    print 'PasswordPool:  {:>8.2f} {:>8.2f} {:>8.2f}'.format(*pooled)
+
+if __name__ == '__main__':
+    main()
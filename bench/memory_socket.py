@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+# Measures body throughput over an in-memory HTTPSocket pair, the previous
+# FakeSocketPair against MemorySocket.
+#
+#   python bench/memory_socket.py [body_size] [piece_size]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gevent import spawn
+from gevent.event import Event
+
+from atom.http import HTTPSocket, HTTPHeaders, memory_socket_pair
+
+LEGACY_BUFFER_SIZE = 8192
+
+
+class LegacyFakeSocketPair(object):
+    # FakeSocketPair as it was: one string buffer per direction, appended
+    # to and sliced for every piece, and a fixed buffer size
+    def __new__(cls):
+        a, b = object.__new__(cls), object.__new__(cls)
+        a._other, b._other = b, a
+        for s in (a, b):
+            s._buf = ''
+            s._read = Event()
+            s._wrote = Event()
+            s._closed = False
+        return a, b
+    
+    def recv(self, size):
+        while not self._closed and len(self._buf) == 0:
+            self._wrote.wait()
+            self._wrote.clear()
+        data, self._buf = self._buf[:size], self._buf[size:]
+        self._read.set()
+        return data
+    
+    def recv_into(self, buf, size = 0):
+        data = self.recv(size or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+    
+    def sendall(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        while len(data) > 0:
+            while not self._closed and len(self._other._buf) >= LEGACY_BUFFER_SIZE:
+                self._other._read.wait()
+                self._other._read.clear()
+            if self._closed:
+                return
+            size = min(len(data), LEGACY_BUFFER_SIZE-len(self._other._buf))
+            piece, data = data[:size], data[size:]
+            self._other._buf += piece
+            self._other._wrote.set()
+    
+    def close(self):
+        for s in (self, self._other):
+            s._closed = True
+            s._read.set()
+            s._wrote.set()
+
+
+def transfer(pair, body_size, piece_size):
+    client, server = HTTPSocket(pair[0], 'client'), HTTPSocket(pair[1], 'server')
+    piece = 'x' * piece_size
+    
+    def send():
+        request = HTTPHeaders.request('POST', '/upload')
+        request.set('Content-Length', str(body_size))
+        client.send_headers(request, more = True)
+        client.send_body(piece for _ in xrange(body_size // piece_size))
+    
+    start = time.time()
+    sender = spawn(send)
+    server.read_headers()
+    received = sum(len(data) for data in server.read_body())
+    sender.join()
+    assert received == body_size
+    return time.time() - start
+
+
+def main():
+    body_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64*1024*1024
+    piece_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    body_size -= body_size % piece_size
+    
+    legacy = transfer(LegacyFakeSocketPair(), body_size, piece_size)
+    current = transfer(memory_socket_pair(), body_size, piece_size)
+    
+    mb = body_size / 1024.0 / 1024.0
+    print 'body size:       {:>8.1f} MB in {} byte pieces'.format(mb, piece_size)
+    print 'FakeSocketPair:  {:>8.1f} MB/s'.format(mb / legacy)
+    print 'MemorySocket:    {:>8.1f} MB/s'.format(mb / current)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# Counts how many bytes get copied in Python while reading one request,
+# comparing the old string-concatenating reader with ReceiveBuffer.
+#
+#   python bench/recv_buffer.py [body_size]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from atom.http import HTTPSocket
+from atom.http.buffer import ReceiveBuffer
+
+SEGMENT_SIZE = 4096
+
+
+class ScriptedSocket(object):
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+    
+    def recv(self, size):
+        size = min(size, SEGMENT_SIZE)
+        data = self._data[self._pos:self._pos+size]
+        self._pos += len(data)
+        return data
+    
+    def recv_into(self, buf, size = 0):
+        data = self.recv(size or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+class CountingBuffer(ReceiveBuffer):
+    copied = 0
+    
+    def _make_room(self):
+        CountingBuffer.copied += len(self)
+        ReceiveBuffer._make_room(self)
+    
+    def read(self, size):
+        CountingBuffer.copied += size
+        return ReceiveBuffer.read(self, size)
+
+
+class LegacyReader(object):
+    # The line and byte readers as they were before ReceiveBuffer, with every
+    # string concatenation and slice counted
+    def __init__(self, sock):
+        self._sock = sock
+        self._buf = ''
+        self.copied = 0
+    
+    def _recv(self):
+        data = self._sock.recv(4096)
+        self._buf += data
+        self.copied += len(self._buf)
+    
+    def read_line(self):
+        while b'\r\n' not in self._buf:
+            self._recv()
+        line, self._buf = self._buf.split(b'\r\n',1)
+        self.copied += len(line) + len(self._buf)
+        return line
+    
+    def read_bytes(self, size):
+        while size > 0:
+            if len(self._buf) == 0:
+                self._recv()
+            piece, self._buf = self._buf[:size], self._buf[size:]
+            self.copied += len(piece) + len(self._buf)
+            size -= len(piece)
+
+
+def make_request(body_size, num_headers = 40):
+    lines = ['POST /upload HTTP/1.1', 'Host: example.com']
+    lines.extend('X-Header-{}: {}'.format(i, 'v' * 60) for i in xrange(num_headers))
+    lines.append('Content-Length: {}'.format(body_size))
+    return '\r\n'.join(lines) + '\r\n\r\n' + 'x' * body_size
+
+
+def run_legacy(request):
+    reader = LegacyReader(ScriptedSocket(request))
+    content_length = None
+    while True:
+        line = reader.read_line()
+        if line == '':
+            break
+        if line.startswith('Content-Length:'):
+            content_length = int(line.split(':',1)[1])
+    reader.read_bytes(content_length)
+    return reader.copied
+
+
+def run_buffer(request):
+    CountingBuffer.copied = 0
+    sock = HTTPSocket(ScriptedSocket(request), 'server')
+    sock._buf = CountingBuffer(sock._sock)
+    sock.read_headers()
+    for piece in sock.read_body():
+        pass
+    return CountingBuffer.copied
+
+
+def main():
+    body_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024*1024
+    request = make_request(body_size)
+    
+    legacy = run_legacy(request)
+    current = run_buffer(request)
+    
+    print 'request size:  {:>12} bytes'.format(len(request))
+    print 'legacy reader: {:>12} bytes copied'.format(legacy)
+    print 'ReceiveBuffer: {:>12} bytes copied'.format(current)
+
+if __name__ == '__main__':
+    main()
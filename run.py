@@ -4,6 +4,8 @@ import os
 
 from atom.router import Router
 
+# Nobody can log in until a user has been added:
+#   python add_user.py config.db <name>
 Router(ip          = '127.0.0.1',
        port        = 8080,
        apps_dir    = os.path.abspath('../../'),